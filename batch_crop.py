@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+'''Crop a batch of images using every core on the machine.
+
+Usage:
+
+    ./batch_crop.py [options] path/to/*.jpg
+    ./sp_crop.py [options] path/to/*.jpg
+    ./crop_morphology.py [options] path/to/*.jpg
+
+Each image is cropped to path/to/image.crop.png by a multiprocessing pool,
+skipping any whose output already exists (unless --overwrite), and one line
+of JSON per file (status, crop box, seconds taken, error) is appended to the
+manifest, so a whole volume can be re-cropped without going through Redis.
+'''
+
+import argparse
+import glob
+import json
+import os
+import random
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+from time import time
+
+from crop_stats import CropStats
+
+
+def out_path_for(path):
+    """Where path's crop goes: path/to/image.jpg (or .tiff, .png, ...) -> path/to/image.crop.png"""
+    return os.path.splitext(path)[0] + '.crop.png'
+
+
+def crop_one(job):
+    """Crop a single image in a pool process and describe how it went.
+
+    job is (process_image, path, out_path), optionally followed by a flag to
+    pass process_image a CropStats and return its record as result["stats"],
+    and another to have that record each stage's peak memory too.
+    """
+    process_image, path, out_path = job[:3]
+    stats = CropStats(path, track_memory=len(job) > 4 and job[4]) if len(job) > 3 and job[3] else None
+    result = {"infile": path,
+              "outfile": out_path,
+              "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S")}
+    start = time()
+    try:
+        if stats is not None:
+            box = process_image(path, out_path, stats=stats)
+            result["stats"] = stats.as_dict()
+        else:
+            box = process_image(path, out_path)
+        # (not whether out_path exists, which with --overwrite may be a crop left by an earlier run)
+        result["status"] = "cropped" if box is not None else "no text"
+        if box is not None:
+            result["box"] = [int(x) for x in box]
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+    result["seconds"] = round(time() - start, 3)
+    return result
+
+
+def run_batch(process_image, files, processes=None, chunksize=1, manifest=None, overwrite=False):
+    """Crop files with process_image across a pool of processes.
+
+    Files whose output already exists are skipped (and logged as such)
+    unless overwrite is set. Returns the list of per-file result dicts, which
+    are also appended to the manifest file as JSON lines if one is given.
+    """
+    jobs = []
+    results = []
+    for path in files:
+        out_path = out_path_for(path)
+        if os.path.abspath(out_path) == os.path.abspath(path):
+            # never write a crop over its own source
+            results.append({"infile": path, "outfile": out_path, "status": "error",
+                            "error": "Output path is the input file",
+                            "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S")})
+            continue
+        if not overwrite and os.path.exists(out_path):
+            results.append({"infile": path, "outfile": out_path, "status": "skipped",
+                            "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S")})
+            continue
+        jobs.append((process_image, path, out_path))
+
+    mf = open(manifest, 'a') if manifest else None
+    try:
+        if mf:
+            for result in results:
+                mf.write(json.dumps(result) + "\n")
+        pool = Pool(processes or cpu_count())
+        try:
+            for result in pool.imap_unordered(crop_one, jobs, chunksize):
+                results.append(result)
+                if mf:
+                    mf.write(json.dumps(result) + "\n")
+                    mf.flush()
+                print('%s -> %s (%s, %.2fs)' % (result["infile"], result["outfile"], result["status"],
+                                                result["seconds"]))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if mf:
+            mf.close()
+    return results
+
+
+def main(process_image, argv=None):
+    """Command line entry point shared by sp_crop and crop_morphology."""
+    parser = argparse.ArgumentParser(description="Crop images to the portions containing text.")
+    parser.add_argument("files", nargs="+", help="images to crop, or a single quoted glob")
+    parser.add_argument("-j", "--processes", type=int, default=cpu_count(),
+                        help="number of worker processes (default: one per core)")
+    parser.add_argument("-c", "--chunksize", type=int, default=1,
+                        help="number of files handed to a worker at a time")
+    parser.add_argument("-m", "--manifest", default="crop_manifest.jsonl",
+                        help="JSON lines file to append per-file results to")
+    parser.add_argument("-o", "--overwrite", action="store_true",
+                        help="re-crop files whose output already exists")
+    args = parser.parse_args(argv)
+
+    if len(args.files) == 1 and '*' in args.files[0]:
+        files = glob.glob(args.files[0])
+        random.shuffle(files)
+    else:
+        files = args.files
+
+    results = run_batch(process_image, files, args.processes, args.chunksize, args.manifest, args.overwrite)
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    print(", ".join("%s %s" % (n, status) for status, n in sorted(counts.items())))
+
+
+if __name__ == '__main__':
+    from sp_crop import process_image
+    main(process_image)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+'''Compare full resolution crop analysis against a downscaled analysis pass.
+
+Usage:
+
+    ./crop_benchmark.py 'path/to/samples/*.jpg' [max_dim]
+
+Runs sp_crop.process_image over each page twice, once at full resolution and
+once with the analysis shrunk to max_dim px (default 2048) on the long edge,
+and reports the time per page and how well the two crop boxes agree (IoU).
+The cropped images are written to a temporary directory and thrown away.
+'''
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+
+from sp_crop import process_image
+
+
+def box_iou(box1, box2):
+    """Intersection over union of two (x1, y1, x2, y2) boxes."""
+    if box1 is None or box2 is None:
+        return 1.0 if box1 == box2 else 0.0
+    ix1, iy1 = max(box1[0], box2[0]), max(box1[1], box2[1])
+    ix2, iy2 = min(box1[2], box2[2]), min(box1[3], box2[3])
+    inter = max(0, ix2 - ix1) * max(0, iy2 - iy1)
+    area1 = (box1[2] - box1[0]) * (box1[3] - box1[1])
+    area2 = (box2[2] - box2[0]) * (box2[3] - box2[1])
+    union = area1 + area2 - inter
+    if union <= 0:
+        return 1.0 if box1 == box2 else 0.0
+    return 1.0 * inter / union
+
+
+def timed_crop(path, out_path, max_dim=None):
+    start = time()
+    box = process_image(path, out_path, max_dim=max_dim)
+    return box, time() - start
+
+
+def run_benchmark(files, max_dim=2048):
+    """Crop each file at full and reduced analysis resolution.
+
+    Returns a list of (path, full_seconds, small_seconds, iou) tuples.
+    """
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for i, path in enumerate(files):
+            out_path = os.path.join(tmp_dir, "%s.png" % i)
+            full_box, full_time = timed_crop(path, out_path)
+            small_box, small_time = timed_crop(path, out_path, max_dim)
+            iou = box_iou(full_box, small_box)
+            results.append((path, full_time, small_time, iou))
+            print('%s: full %.2fs, %spx %.2fs, IoU %.3f' % (path, full_time, max_dim, small_time, iou))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    files = sorted(glob.glob(sys.argv[1]))
+    max_dim = int(sys.argv[2]) if len(sys.argv) > 2 else 2048
+    if not files:
+        print("No files match %s" % sys.argv[1])
+        sys.exit(1)
+
+    results = run_benchmark(files, max_dim)
+    n = len(results)
+    full_total = sum(r[1] for r in results)
+    small_total = sum(r[2] for r in results)
+    ious = [r[3] for r in results]
+    print('----')
+    print('%s pages' % n)
+    print('Full resolution: %.2fs per page' % (full_total / n))
+    print('%spx analysis: %.2fs per page (%.1fx)' % (max_dim, small_total / n, full_total / max(small_total, 1e-9)))
+    print('Box IoU: mean %.3f, min %.3f, %s pages below 0.95' % (
+        sum(ious) / n, min(ious), len([i for i in ious if i < 0.95])))
@@ -0,0 +1,76 @@
+'''Persistent store of crop boxes, so pages only need analysing once.
+
+Boxes are keyed by a hash of the image file's contents plus the settings
+that produced them (see crop_engine.CropParams.cache_key), so moving or
+renaming a file still hits the cache, and changing the algorithm or its
+settings misses it.
+
+    from crop_cache import CropCache
+    from sp_crop import compute_crop, process_image
+
+    cache = CropCache("crop_cache.sqlite")
+    box = compute_crop("page.jpg", cache=cache)
+    process_image("page.jpg", "page.crop.png", cache=cache)  # no re-analysis
+'''
+
+import hashlib
+import json
+import sqlite3
+
+
+def file_hash(path, blocksize=1 << 20):
+    """sha1 of a file's contents, read a block at a time."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            h.update(block)
+            block = f.read(blocksize)
+    return h.hexdigest()
+
+
+class CropCache(object):
+    """Crop boxes stored in a small SQLite database.
+
+    The connection is opened on first use, so a cache can be handed to pool
+    processes and each will open its own.
+    """
+
+    def __init__(self, db_path="crop_cache.sqlite"):
+        self.db_path = db_path
+        self._conn = None
+
+    def __getstate__(self):
+        return {"db_path": self.db_path, "_conn": None}
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, timeout=30)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS crops "
+                               "(hash TEXT, params TEXT, box TEXT, PRIMARY KEY (hash, params))")
+            self._conn.commit()
+        return self._conn
+
+    def key(self, path, params):
+        """Cache key for the file at path analysed with the params dict."""
+        return file_hash(path), json.dumps(params, sort_keys=True)
+
+    def get(self, key):
+        """Returns (hit, box); box may be None if the page had no text."""
+        row = self.conn.execute("SELECT box FROM crops WHERE hash = ? AND params = ?", key).fetchone()
+        if row is None:
+            return False, None
+        box = json.loads(row[0])
+        return True, tuple(box) if box is not None else None
+
+    def put(self, key, box):
+        box = [int(x) for x in box] if box is not None else None
+        self.conn.execute("INSERT OR REPLACE INTO crops (hash, params, box) VALUES (?, ?, ?)",
+                          key + (json.dumps(box),))
+        self.conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,825 @@
+#!/usr/bin/env python
+'''Crop an image to just the portions containing text.
+
+This is the crop engine shared by sp_crop.py and crop_morphology.py, which
+are now just presets of its settings (see CropParams, SP_CROP and
+CROP_MORPHOLOGY below). Any tuning or speed up done here applies to both,
+and presets can be compared with crop_regression.py.
+
+For details on the methodology, see
+http://www.danvk.org/2015/01/07/finding-blocks-of-text-in-an-image-using-python-opencv-and-numpy.html
+
+MODIFIED for Scottish Session Papers project - Mike Bennett <mike.bennett@ed.ac.uk>
+'''
+
+import cv2
+from PIL import Image
+import numpy as np
+from scipy.ndimage.filters import rank_filter
+
+from tiff_reader import tiff_memmap, gray_proxy, crop_region
+from crop_stats import stage
+
+
+class CropParams(object):
+    """Settings for the crop engine.
+
+    margin: px cut off the left and right of the page before anything else
+    max_dim: analyse a copy shrunk to this long edge (None for full size)
+    threshold: binarise the grayscale page at this level first (None to
+        run Canny on the grayscale directly)
+    canny: the (low, high) Canny thresholds
+    remove_border: look for a printed border and drop everything outside it
+    border_engine: 'projection' to try find_border_lines() first, falling
+        back to contours only if it can't decide, or 'contours' to always
+        use find_border()
+    deborder_engine: implementation used by deborder()
+    max_components: keep dilating until there are at most this many contours
+    min_remaining_frac, max_new_area_frac: see find_optimal_components_subset()
+    pad_px: see pad_crop()
+    fast_decode, mmap_tiff: see reduced_image()
+    verbose: print what's happening
+    """
+
+    defaults = {"name": "custom",
+                "margin": 0,
+                "max_dim": None,
+                "threshold": None,
+                "canny": (100, 200),
+                "remove_border": False,
+                "border_engine": "projection",
+                "deborder_engine": "opencv",
+                "max_components": 30,
+                "min_remaining_frac": 0.10,
+                "max_new_area_frac": 0.35,
+                "pad_px": 15,
+                "fast_decode": False,
+                "mmap_tiff": False,
+                "verbose": False}
+
+    # Settings that can't change the crop box, so don't count for the cache
+    not_in_key = ("name", "deborder_engine", "verbose")
+
+    def __init__(self, **settings):
+        for key in settings:
+            if key not in self.defaults:
+                raise TypeError("Unknown crop setting: %s" % key)
+        self.__dict__.update(self.defaults)
+        self.__dict__.update(settings)
+
+    def replace(self, **changes):
+        """A copy of these settings with some of them changed."""
+        settings = self.as_dict()
+        settings.update(changes)
+        return CropParams(**settings)
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.defaults)
+
+    def cache_key(self):
+        """The settings that affect the crop box, used to key the crop cache.
+
+        Bump 'version' whenever the analysis changes in a way that moves boxes."""
+        key = dict((k, v) for k, v in self.as_dict().items() if k not in self.not_in_key)
+        key["canny"] = list(key["canny"])
+        key["version"] = 4
+        return key
+
+    def __repr__(self):
+        changed = ["%s=%r" % (k, v) for k, v in sorted(self.as_dict().items())
+                   if k != "name" and v != self.defaults[k]]
+        return "CropParams(%s: %s)" % (self.name, ", ".join(changed))
+
+
+# The original sp_crop.py: trim the sides, binarise, no border removal
+SP_CROP = CropParams(name="sp_crop", margin=50, threshold=120, max_components=30,
+                     min_remaining_frac=0.10, max_new_area_frac=0.35)
+
+# The original crop_morphology.py: analyse at 2048px, remove printed borders
+CROP_MORPHOLOGY = CropParams(name="crop_morphology", max_dim=2048, remove_border=True, max_components=16,
+                             min_remaining_frac=0.25, max_new_area_frac=0.15)
+
+presets = {"sp_crop": SP_CROP, "crop_morphology": CROP_MORPHOLOGY}
+
+
+def find_contours(ary, mode=cv2.RETR_TREE, method=cv2.CHAIN_APPROX_SIMPLE):
+    """cv2.findContours, returning (contours, hierarchy) whichever OpenCV
+    version is installed (3.x also returns the image first)."""
+    result = cv2.findContours(ary, mode, method)
+    return result[-2], result[-1]
+
+
+def box_points(rect):
+    """Corners of a rotated rectangle (cv2.cv.BoxPoints before OpenCV 3)."""
+    if hasattr(cv2, 'boxPoints'):
+        return cv2.boxPoints(rect)
+    return cv2.cv.BoxPoints(rect)
+
+
+def dilate(ary, N, iterations): 
+    """Dilate using an NxN '+' sign shape. ary is np.uint8."""
+    kernel = np.zeros((N,N), dtype=np.uint8)
+    kernel[(N-1)//2,:] = 1
+    dilated_image = cv2.dilate(ary // 255, kernel, iterations=iterations)
+
+    kernel = np.zeros((N,N), dtype=np.uint8)
+    kernel[:,(N-1)//2] = 1
+    dilated_image = cv2.dilate(dilated_image, kernel, iterations=iterations)
+    return dilated_image
+
+
+def props_for_contours(contours, ary, mode='labels'):
+    """Calculate bounding box & the number of set pixels for each contour.
+
+    mode='labels' rasterizes every contour once into a single int32 label
+    image and gets all the pixel sums from one np.bincount pass.
+    mode='draw' is the original approach of drawing each contour onto its own
+    full-page canvas; much slower on big scans, but kept for comparison.
+    """
+    if mode == 'draw':
+        return props_for_contours_draw(contours, ary)
+    if len(contours) == 0:
+        return []
+
+    boxes = [cv2.boundingRect(c) for c in contours]
+    # Paint the biggest contours first, so anything nested inside a contour
+    # overwrites it and each label ends up holding only its "own" pixels.
+    # (A parent/hole pair can have identical boxes, so the area inside each
+    # outline breaks ties: the hole's is the smaller.)
+    areas = [cv2.contourArea(c) for c in contours]
+    order = sorted(range(len(contours)), key=lambda i: (-boxes[i][2] * boxes[i][3], -areas[i]))
+    parents = contour_parents(contours, boxes, order)
+    labels = np.zeros(ary.shape[:2], dtype=np.int32)
+    for i in order:
+        cv2.drawContours(labels, contours, i, i + 1, -1)
+
+    # Sibling contours (e.g. two holes either side of a 1px wall) can share
+    # outline pixels, which a single label per pixel can't represent. So take
+    # every outline pixel out of the label image and count those separately.
+    width = ary.shape[1]
+    outlines = [outline_pixels(c, width) for c in contours]
+    flat_ary = ary.ravel()
+    labels = labels.ravel()
+    labels[np.concatenate(outlines)] = 0
+
+    # Only the set pixels can contribute, and edge maps are mostly empty.
+    nz = np.flatnonzero(flat_ary)
+    sums = np.bincount(labels[nz], weights=flat_ary[nz], minlength=len(contours) + 1)[1:]
+    # A filled contour covers everything nested inside it, so roll the
+    # children up into their parents, deepest first.
+    for i in reversed(order):
+        if parents[i] >= 0:
+            sums[parents[i]] += sums[i]
+            outlines[parents[i]] = np.union1d(outlines[parents[i]], outlines[i])
+
+    c_info = []
+    for (x, y, w, h), s, outline in zip(boxes, sums, outlines):
+        c_info.append({
+            'x1': x,
+            'y1': y,
+            'x2': x + w - 1,
+            'y2': y + h - 1,
+            'sum': (s + np.sum(flat_ary[outline])) / 255
+        })
+    return c_info
+
+
+def props_for_contours_draw(contours, ary):
+    """Original props_for_contours: one full-page canvas per contour."""
+    c_info = []
+    for c in contours:
+        x,y,w,h = cv2.boundingRect(c)
+        c_im = np.zeros(ary.shape)
+        cv2.drawContours(c_im, [c], 0, 255, -1)
+        c_info.append({
+            'x1': x,
+            'y1': y,
+            'x2': x + w - 1,
+            'y2': y + h - 1,
+            'sum': np.sum(ary * (c_im > 0))/255
+        })
+    return c_info
+
+
+def outline_pixels(contour, width):
+    """Flat indices of the pixels a contour's outline runs through.
+
+    CHAIN_APPROX_SIMPLE only drops the points in the middle of horizontal,
+    vertical and diagonal runs, so stepping between the vertices recovers
+    the outline exactly."""
+    pts = contour.reshape(-1, 2).astype(np.intp)
+    d = np.roll(pts, -1, axis=0) - pts
+    steps = np.abs(d).max(axis=1)
+    if steps.sum() == 0:
+        steps[0] = 1
+    seg = np.repeat(np.arange(len(pts)), steps)
+    k = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)
+    xy = pts[seg] + k[:, None] * np.sign(d[seg])
+    return np.unique(xy[:, 1] * width + xy[:, 0])
+
+
+def contour_parents(contours, boxes, order):
+    """Find the innermost contour enclosing each contour (-1 for none).
+
+    order must list bigger contours first; a contour can only be enclosed by
+    one that comes before it."""
+    parents = [-1] * len(contours)
+    for n, j in enumerate(order):
+        xj, yj, wj, hj = boxes[j]
+        pts = contours[j].reshape(-1, 2)
+        # walk back from the smallest candidate so the first hit is innermost
+        for i in reversed(order[:n]):
+            xi, yi, wi, hi = boxes[i]
+            if not (xi <= xj and yi <= yj and xj + wj <= xi + wi and yj + hj <= yi + hi):
+                continue
+            if all(cv2.pointPolygonTest(contours[i], (float(x), float(y)), False) >= 0
+                   for x, y in pts) and fill_inside(contours[j], contours[i], boxes[j]):
+                parents[j] = i
+                break
+    return parents
+
+
+def fill_inside(inner, outer, box):
+    """Whether every pixel drawContours fills for inner is filled for outer
+    too. Having all its vertices inside or on outer isn't enough: where one
+    contour touches another (e.g. a hole whose outline runs round a blob
+    joined to its edge), the outer one's outline can wrap round the inner
+    one's pixels. Only box, inner's bounding rect, needs drawing."""
+    x, y, w, h = box
+    a = np.zeros((h, w), dtype=np.uint8)
+    b = np.zeros((h, w), dtype=np.uint8)
+    cv2.drawContours(a, [inner], 0, 1, -1, offset=(-x, -y))
+    cv2.drawContours(b, [outer], 0, 1, -1, offset=(-x, -y))
+    return not np.any(a > b)
+
+
+def union_crops(crop1, crop2):
+    """Union two (x1, y1, x2, y2) rects."""
+    x11, y11, x21, y21 = crop1
+    x12, y12, x22, y22 = crop2
+    return min(x11, x12), min(y11, y12), max(x21, x22), max(y21, y22)
+
+
+def intersect_crops(crop1, crop2):
+    x11, y11, x21, y21 = crop1
+    x12, y12, x22, y22 = crop2
+    return max(x11, x12), max(y11, y12), min(x21, x22), min(y21, y22)
+
+
+def crop_area(crop):
+    x1, y1, x2, y2 = crop
+    return max(0, x2 - x1) * max(0, y2 - y1)
+
+
+def find_border_components(contours, ary):
+    borders = []
+    area = ary.shape[0] * ary.shape[1]
+    for i, c in enumerate(contours):
+        x,y,w,h = cv2.boundingRect(c)
+        if w * h > 0.5 * area:
+            borders.append((i, x, y, x + w - 1, y + h - 1))
+    return borders
+
+
+def angle_from_right(deg):
+    return min(deg % 90, 90 - (deg % 90))
+
+
+def remove_border(contour, ary):
+    """Remove everything outside a border contour."""
+    # Use a rotated rectangle (should be a good approximation of a border).
+    # If it's far from a right angle, it's probably two sides of a border and
+    # we should use the bounding box instead.
+    c_im = np.zeros(ary.shape)
+    r = cv2.minAreaRect(contour)
+    degs = r[2]
+    if angle_from_right(degs) <= 10.0:
+        box = box_points(r)
+        box = np.int32(box)
+        cv2.drawContours(c_im, [box], 0, 255, -1)
+        cv2.drawContours(c_im, [box], 0, 0, 4)
+    else:
+        x1, y1, x2, y2 = cv2.boundingRect(contour)
+        cv2.rectangle(c_im, (x1, y1), (x2, y2), 255, -1)
+        cv2.rectangle(c_im, (x1, y1), (x2, y2), 0, 4)
+
+    return np.minimum(c_im, ary)
+
+
+def window_counts(binary, size, axis, engine='opencv'):
+    """Count the set pixels in a size-long window along axis at every pixel.
+
+    The window and the (reflected) edge handling match scipy's rank_filter,
+    i.e. it covers offsets -size//2 .. size - size//2 - 1. binary is 0/1.
+    """
+    before = size // 2
+    if engine == 'opencv':
+        ksize, anchor = ((size, 1), (before, 0)) if axis == 1 else ((1, size), (0, before))
+        return cv2.boxFilter(binary, cv2.CV_32S, ksize, anchor=anchor,
+                             normalize=False, borderType=cv2.BORDER_REFLECT)
+    # cumulative sum: count = csum[i + size] - csum[i] over the padded array
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (before, size - before - 1)
+    padded = np.pad(binary, pad, mode='symmetric')
+    csum = np.cumsum(padded, axis=axis, dtype=np.int32)
+    csum = np.insert(csum, 0, 0, axis=axis)
+    n = binary.shape[axis]
+    return np.take(csum, np.arange(size, size + n), axis=axis) - np.take(csum, np.arange(n), axis=axis)
+
+
+def deborder(edges, engine='opencv'):
+    """Remove ~1px borders, i.e. edge pixels with fewer than 4 set pixels in
+    the 20px around them along their row or along their column.
+
+    engine='scipy' is the original pair of rank filters. 'opencv' (box filter)
+    and 'cumsum' (numpy cumulative sums) count the set pixels in each window
+    instead, which gives the same result for a 0/255 edge image, much faster.
+    """
+    if engine == 'scipy':
+        maxed_rows = rank_filter(edges, -4, size=(1, 20))
+        maxed_cols = rank_filter(edges, -4, size=(20, 1))
+        return np.minimum(np.minimum(edges, maxed_rows), maxed_cols)
+
+    binary = (edges > 0).astype(np.uint8)
+    # The 4th biggest value in a 0/255 window is 255 iff it holds >= 4 set pixels
+    keep = (window_counts(binary, 20, 1, engine) >= 4) & (window_counts(binary, 20, 0, engine) >= 4)
+    return np.where(keep, edges, 0).astype(edges.dtype)
+
+
+def find_components_steps(edges, max_components=30):
+    """Dilate the image until there are just a few connected components.
+
+    Returns (contours, n) where n is the number of dilation iterations it
+    took, which is handy when tuning max_components."""
+    # dilate(edges, N=3, iterations=n) amounts to a (2n+1)x(2n+1) square, so
+    # rather than starting over from the edges for every n, grow the last
+    # result by one more 3x3 step.
+    kernel = np.ones((3, 3), dtype=np.uint8)
+    n = 2
+    dilated_image = cv2.dilate((edges > 0).astype(np.uint8), kernel, iterations=n)
+    contours, hierarchy = find_contours(dilated_image)
+    while len(contours) > max_components:
+        n += 1
+        dilated_image = cv2.dilate(dilated_image, kernel)
+        contours, hierarchy = find_contours(dilated_image)
+    return contours, n
+
+
+def find_components(edges, max_components=30):
+    """Dilate the image until there are just a few connected components.
+
+    Returns contours for these components."""
+    contours, n = find_components_steps(edges, max_components)
+    return contours
+
+
+def find_optimal_components_subset(contours, edges, c_info=None, min_remaining_frac=0.10,
+                                   max_new_area_frac=0.35):
+    """Find a crop which strikes a good balance of coverage/compactness.
+
+    c_info is the props_for_contours() list for contours, if the caller
+    already has it (it isn't modified). A component that doesn't improve
+    the f1 score is still taken if it holds more than min_remaining_frac of
+    the uncovered pixels and grows the crop by less than max_new_area_frac.
+
+    Returns an (x1, y1, x2, y2) tuple.
+    """
+    if c_info is None:
+        c_info = props_for_contours(contours, edges)
+    c_info = sorted(c_info, key=lambda x: -x['sum'])
+    total = np.sum(edges) / 255
+    area = edges.shape[0] * edges.shape[1]
+
+    c = c_info[0]
+    crop = c['x1'], c['y1'], c['x2'], c['y2']
+    covered_sum = c['sum']
+
+    # The rest of the candidates as arrays, so each round can score all of
+    # them at once. They stay in sorted order, and taking the first one that
+    # passes gives the same pick as scanning the list did.
+    x1s = np.array([c['x1'] for c in c_info[1:]], dtype=np.int64)
+    y1s = np.array([c['y1'] for c in c_info[1:]], dtype=np.int64)
+    x2s = np.array([c['x2'] for c in c_info[1:]], dtype=np.int64)
+    y2s = np.array([c['y2'] for c in c_info[1:]], dtype=np.int64)
+    sums = np.array([c['sum'] for c in c_info[1:]], dtype=np.float64)
+    remaining = np.ones(len(sums), dtype=bool)
+
+    while covered_sum < total and remaining.any():
+        recall = 1.0 * covered_sum / total
+        prec = 1 - 1.0 * crop_area(crop) / area
+        f1 = 2 * (prec * recall / (prec + recall))
+        #print( '----')
+        # union of the current crop with every candidate
+        nx1 = np.minimum(x1s, crop[0])
+        ny1 = np.minimum(y1s, crop[1])
+        nx2 = np.maximum(x2s, crop[2])
+        ny2 = np.maximum(y2s, crop[3])
+        new_areas = np.maximum(0, nx2 - nx1) * np.maximum(0, ny2 - ny1)
+        new_sums = covered_sum + sums
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_recall = 1.0 * new_sums / total
+            new_prec = 1 - 1.0 * new_areas / area
+            new_f1 = 2 * new_prec * new_recall / (new_prec + new_recall)
+
+            # Add this crop if it improves f1 score,
+            # _or_ it adds enough of the remaining pixels for a small crop expansion.
+            # ^^^ very ad-hoc! make this smoother
+            remaining_frac = sums / (total - covered_sum)
+            new_area_frac = 1.0 * new_areas / crop_area(crop) - 1
+        # A zero-area crop (where the old loop raised ZeroDivisionError) gives inf/nan area fractions, and takes nothing
+        accept = remaining & np.isfinite(new_area_frac) & ((new_f1 > f1) | (
+            (remaining_frac > min_remaining_frac) & (new_area_frac < max_new_area_frac)))
+        if not accept.any():
+            break
+
+        i = np.argmax(accept)
+        crop = int(nx1[i]), int(ny1[i]), int(nx2[i]), int(ny2[i])
+        covered_sum = new_sums[i]
+        remaining[i] = False
+
+    return crop
+
+
+def pad_crop(crop, contours, edges, border_contour, pad_px=15, c_info=None):
+    """Slightly expand the crop to get full contours.
+
+    This will expand to include any contours it currently intersects, but will
+    not expand past a border. Keeps going until the crop stops changing.
+    c_info is the props_for_contours() list for contours, if already known.
+    """
+    bx1, by1, bx2, by2 = 0, 0, edges.shape[0], edges.shape[1]
+    if border_contour is not None and len(border_contour) > 0:
+        c = props_for_contours([border_contour], edges)[0]
+        bx1, by1, bx2, by2 = c['x1'] + 5, c['y1'] + 5, c['x2'] - 5, c['y2'] - 5
+
+    def crop_in_border(crop):
+        x1, y1, x2, y2 = crop
+        x1 = max(x1 - pad_px, bx1)
+        y1 = max(y1 - pad_px, by1)
+        x2 = min(x2 + pad_px, bx2)
+        y2 = min(y2 + pad_px, by2)
+        return crop
+    
+    if c_info is None:
+        c_info = props_for_contours(contours, edges)
+
+    changed = True
+    while changed:
+        crop = crop_in_border(crop)
+        changed = False
+        for c in c_info:
+            this_crop = c['x1'], c['y1'], c['x2'], c['y2']
+            this_area = crop_area(this_crop)
+            int_area = crop_area(intersect_crops(crop, this_crop))
+            new_crop = crop_in_border(union_crops(crop, this_crop))
+            if 0 < int_area < this_area and crop != new_crop:
+                #print '%s -> %s' % (str(crop), str(new_crop))
+                changed = True
+                crop = new_crop
+
+    return crop
+
+
+def downscale_image(im, max_dim=2048):
+    """Shrink im until its longest dimension is <= max_dim.
+
+    Returns new_image, scale (where scale <= 1).
+    """
+    a, b = im.size
+    if max(a, b) <= max_dim:
+        return 1.0, im
+
+    scale = 1.0 * max_dim / max(a, b)
+    new_im = im.resize((int(a * scale), int(b * scale)), Image.LANCZOS)
+    return scale, new_im
+
+
+def open_trimmed(path, margin=0):
+    """Open an image and cut margin px off the left and right."""
+    orig_im = Image.open(path)
+    if not margin:
+        # decode now (crop() does), so it's timed as the decode stage rather than whatever touches it first
+        orig_im.load()
+        return orig_im
+    w, h = orig_im.size
+    return orig_im.crop((margin, 0, w - margin, h))
+
+
+def open_for_analysis(path, max_dim, margin=0):
+    """Open an image for analysis only, as small as the decoder allows.
+
+    JPEGs are decoded straight to grayscale at 1/2, 1/4 or 1/8 size (the
+    smallest that's still at least max_dim on the long side), so the full
+    resolution pixels are never decoded; other formats are just converted.
+    The side margins are trimmed as in open_trimmed().
+
+    Returns scale, image (like downscale_image).
+    """
+    im = Image.open(path)
+    w, h = im.size
+    if max(w, h) > max_dim:
+        shrink = 1.0 * max_dim / max(w, h)
+        im.draft('L', (int(w * shrink), int(h * shrink)))
+    im = im.convert('L')
+    scale = 1.0 * im.size[0] / w
+    trim = int(round(margin * scale))
+    return scale, im.crop((trim, 0, im.size[0] - trim, im.size[1]))
+
+
+def reduced_image(path, params):
+    """Open a shrunk, trimmed copy of the image at path for find_crop(),
+    without decoding it at full size if the params allow.
+
+    mmap_tiff builds the copy a band at a time from an uncompressed TIFF
+    mapped straight from disk (see tiff_reader); fast_decode uses
+    open_for_analysis(). Files neither applies to give (1.0, None).
+
+    Returns scale, image.
+    """
+    if params.mmap_tiff:
+        pixels = tiff_memmap(path)
+        if pixels is not None:
+            scale, proxy = gray_proxy(pixels, params.max_dim)
+            trim = int(round(params.margin * scale))
+            return scale, Image.fromarray(proxy[:, trim:proxy.shape[1] - trim])
+    if params.fast_decode:
+        return open_for_analysis(path, params.max_dim, params.margin)
+    return 1.0, None
+
+
+def find_border(edges, verbose=False):
+    """Find a printed border around the page, if there is one.
+
+    Returns the border's contour, or None.
+    """
+    contours, hierarchy = find_contours(edges)
+    borders = find_border_components(contours, edges)
+    if not borders:
+        return None
+    # the smallest component covering over half the page
+    borders.sort(key=lambda b: (b[3] - b[1]) * (b[4] - b[2]))
+    if verbose:
+        print('border at %s' % (borders[0][1:],))
+    return contours[borders[0][0]]
+
+
+def line_profile(binary, axis, min_frac, skew_px, blocks=32):
+    """Projection profile of long straight lines along axis (1 for
+    horizontal lines, 0 for vertical ones) in a 0/1 edge map.
+
+    The edges are thickened by skew_px across the lines, then each row (or
+    column) is cut into blocks and a block counts as line if it's at least
+    90% set. Returns (line_rows, most_blocks): the indices of rows whose
+    line blocks cover at least min_frac of the page, and the most line
+    blocks found in any band of rows 1/16th of the page deep, which still
+    catches lines too skewed to line up with a single row.
+    """
+    n = binary.shape[1 - axis]
+    across = (2 * skew_px + 1, 1) if axis == 1 else (1, 2 * skew_px + 1)
+    thick = cv2.dilate(binary, np.ones(across, np.uint8))
+    # INTER_AREA averages each block down to one value
+    size = (blocks, n) if axis == 1 else (n, blocks)
+    density = cv2.resize(thick * 255, size, interpolation=cv2.INTER_AREA)
+    cells = (density >= 230).astype(np.uint8)
+    line_rows = np.flatnonzero(np.count_nonzero(cells, axis=axis) >= min_frac * blocks)
+    band = (max(1, n // 16), 1) if axis == 1 else (1, max(1, n // 16))
+    bands = cv2.dilate(cells, np.ones(band, np.uint8))
+    return line_rows, np.count_nonzero(bands, axis=axis).max()
+
+
+def line_runs(idx):
+    """Group sorted indices into runs of consecutive values: [(first, last)]."""
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) > 1)
+    starts = np.concatenate(([idx[0]], idx[breaks + 1]))
+    ends = np.concatenate((idx[breaks], [idx[-1]]))
+    return list(zip(starts, ends))
+
+
+def find_border_lines(edges, min_frac=0.5, skew_px=4, blocks=32):
+    """Look for a printed border as long straight lines in the edge map,
+    using row and column projection profiles (see line_profile()).
+
+    Returns (path, box), where path is
+      'projection': a clear four sided border was found, and box is the
+          (x1, y1, x2, y2) just inside it
+      'none': no long lines in one direction or the other, so nothing
+          big enough to be a border (lines more than a few degrees from
+          square aren't treated as borders)
+      'ambiguous': some long lines, but not a clear, square-on border - use
+          find_border()
+    """
+    h, w = edges.shape
+    binary = (edges > 0).astype(np.uint8)
+    rows, row_blocks = line_profile(binary, 1, min_frac, skew_px, blocks)
+    cols, col_blocks = line_profile(binary, 0, min_frac, skew_px, blocks)
+    if row_blocks < blocks // 4 or col_blocks < blocks // 4:
+        return 'none', None
+
+    row_runs, col_runs = line_runs(rows), line_runs(cols)
+    if len(row_runs) < 2 or len(col_runs) < 2:
+        return 'ambiguous', None
+    # inside edges of the outermost lines
+    x1, x2 = col_runs[0][1] + 1, col_runs[-1][0]
+    y1, y2 = row_runs[0][1] + 1, row_runs[-1][0]
+    if (x2 - x1) * (y2 - y1) <= 0.5 * w * h:
+        return 'ambiguous', None
+    return 'projection', (int(x1), int(y1), int(x2), int(y2))
+
+
+def crop_to_box(box, ary):
+    """Blank everything outside box (x1, y1, x2, y2)."""
+    x1, y1, x2, y2 = box
+    out = np.zeros_like(ary)
+    out[y1:y2, x1:x2] = ary[y1:y2, x1:x2]
+    return out
+
+
+def find_and_remove_border(edges, params):
+    """Find a printed border with params.border_engine and drop everything
+    outside it.
+
+    Returns (edges, border_contour, path), where path is which detector
+    settled it: 'projection', 'none' (the projections found no long lines),
+    or 'contours' (find_border() was needed).
+    """
+    path = 'contours'
+    if params.border_engine == 'projection':
+        path, box = find_border_lines(edges)
+        if path == 'projection':
+            x1, y1, x2, y2 = box
+            border_contour = np.array([[[x1, y1]], [[x2, y1]], [[x2, y2]], [[x1, y2]]], dtype=np.int32)
+            if params.verbose:
+                print('border at %s (projection)' % (box,))
+            return crop_to_box(box, edges), border_contour, path
+        if path == 'none':
+            return edges, None, path
+        path = 'contours'
+    border_contour = find_border(edges, params.verbose)
+    if border_contour is not None:
+        edges = remove_border(border_contour, edges)
+    return edges, border_contour, path
+
+
+def edge_fraction(edges, grid=256):
+    """How much of an edge map has edges in it: the fraction of the cells of
+    a grid, grid cells along its longer side, that hold any edge pixel.
+
+    Canny's edges are a pixel wide whatever the resolution, so the fraction
+    of edge pixels falls as the scan (or max_dim) grows, while this stays
+    about the same for the same page.
+    """
+    h, w = edges.shape
+    cell = max(1, int(np.ceil(1.0 * max(h, w) / grid)))
+    pad_h, pad_w = -h % cell, -w % cell
+    padded = np.pad(edges > 0, ((0, pad_h), (0, pad_w)))
+    cells = padded.reshape((h + pad_h) // cell, cell, (w + pad_w) // cell, cell).any(axis=(1, 3))
+    return float(np.count_nonzero(cells)) / cells.size
+
+
+def find_crop(new_im, params=SP_CROP, pre_scale=1.0, stats=None):
+    """Work out the crop box for an (already trimmed) image.
+
+    If params.max_dim is set, the analysis is done on a copy shrunk so its
+    longest side is at most max_dim px, and the crop box is scaled back up to
+    full resolution. pre_scale is how much new_im has already been shrunk,
+    e.g. by open_for_analysis(). Each stage is timed into stats, if given.
+
+    Returns an (x1, y1, x2, y2) tuple, or None if no text was found.
+    """
+    scale, im = 1.0, new_im
+    if params.max_dim:
+        with stage(stats, 'downscale'):
+            scale, im = downscale_image(new_im, params.max_dim)
+    scale *= pre_scale
+    with stage(stats, 'grayscale'):
+        cvim = np.asarray(im)
+        if cvim.ndim == 2:
+            gray = cvim  # already decoded as grayscale
+        else:
+            gray = cv2.cvtColor(cvim, cv2.COLOR_BGR2GRAY)  # grayscale
+    if params.threshold is not None:
+        with stage(stats, 'threshold'):
+            _, gray = cv2.threshold(gray, params.threshold, 255, cv2.THRESH_BINARY_INV)
+
+    with stage(stats, 'canny'):
+        edges = cv2.Canny(gray, params.canny[0], params.canny[1])
+
+    # TODO: dilate image _before_ finding a border. This is crazy sensitive!
+    border_contour = None
+    if params.remove_border:
+        with stage(stats, 'border'):
+            edges, border_contour, border_path = find_and_remove_border(edges, params)
+        if stats is not None:
+            stats.count('border_path', border_path)
+
+    edges = 255 * (edges > 0).astype(np.uint8)
+
+    # Remove ~1px borders using a rank filter.
+    with stage(stats, 'deborder'):
+        edges = deborder(edges, params.deborder_engine)
+
+    with stage(stats, 'find_components'):
+        contours, n = find_components_steps(edges, params.max_components)
+    if stats is not None:
+        stats.count('dilation_steps', n)
+        stats.count('components', len(contours))
+        # how much of the page is text-like edges (see crop_stats.text_density)
+        stats.count('edge_frac', round(edge_fraction(edges), 6))
+    if len(contours) == 0:
+        return
+
+    # Contour stats are the expensive bit, so work them out once for the page
+    with stage(stats, 'subset'):
+        c_info = props_for_contours(contours, edges)
+        crop = find_optimal_components_subset(contours, edges, c_info, params.min_remaining_frac,
+                                              params.max_new_area_frac)
+    with stage(stats, 'pad'):
+        crop = pad_crop(crop, contours, edges, border_contour, params.pad_px, c_info=c_info)
+
+    crop = tuple(int(x / scale) for x in crop)  # upscale to the original image size.
+    return crop
+
+
+def compute_crop(path, params=SP_CROP, cache=None, stats=None):
+    """Work out the crop box for the image at path, without saving anything.
+
+    If a CropCache is given, a box already worked out for the same file
+    contents and params is returned straight from it, and new boxes are
+    added to it. With params.fast_decode or mmap_tiff (and max_dim) the
+    analysis never decodes the image at full size, see reduced_image().
+    Pass a crop_stats.CropStats as stats to get the time spent in each stage.
+
+    Returns the crop box in the whole image's coordinates (side margins
+    included), or None if no text was found.
+    """
+    return cached_crop(path, None, params, cache, stats)
+
+
+def cached_crop(path, new_im, params, cache, stats=None):
+    """find_crop() via the cache, only opening the image on a miss. new_im,
+    if given, is the image with its side margins trimmed (open_trimmed()),
+    but the box returned and cached is in the whole image's coordinates."""
+    if cache is not None:
+        with stage(stats, 'cache'):
+            key = cache.key(path, params.cache_key())
+            hit, crop = cache.get(key)
+        if hit:
+            return crop
+    small_im = None
+    if params.max_dim and (params.fast_decode or params.mmap_tiff):
+        with stage(stats, 'decode'):
+            pre_scale, small_im = reduced_image(path, params)
+    if small_im is not None:
+        crop = find_crop(small_im, params, pre_scale, stats)
+    else:
+        if new_im is None:
+            with stage(stats, 'decode'):
+                new_im = open_trimmed(path, params.margin)
+        crop = find_crop(new_im, params, stats=stats)
+    if crop is not None:
+        x1, y1, x2, y2 = crop
+        crop = (x1 + params.margin, y1, x2 + params.margin, y2)
+    if cache is not None:
+        cache.put(key, crop)
+    return crop
+
+
+def process_image(path, out_path, params=SP_CROP, cache=None, stats=None):
+    """Crop the image at path down to its text and save it to out_path.
+
+    The saved image is always full resolution; params, cache and stats are
+    as for compute_crop(). With params.mmap_tiff, an uncompressed TIFF is
+    never loaded whole: only the rows inside the crop are read back from
+    disk to save it.
+
+    Returns the crop box in the whole image's coordinates, as compute_crop(),
+    or None if no text was found.
+    """
+    pixels = tiff_memmap(path) if params.mmap_tiff and params.max_dim else None
+    # Otherwise with fast_decode, the full size image is only decoded to cut the crop
+    new_im = None
+    if not ((pixels is not None or params.fast_decode) and params.max_dim):
+        with stage(stats, 'decode'):
+            new_im = open_trimmed(path, params.margin)
+    crop = cached_crop(path, new_im, params, cache, stats)
+    if crop is None:
+        if params.verbose:
+            print('%s -> (no text!)' % path)
+        return
+    if pixels is not None:
+        with stage(stats, 'save'):
+            crop_region(pixels, crop).save(out_path)
+    else:
+        if new_im is None:
+            with stage(stats, 'decode_full'):
+                new_im = open_trimmed(path, params.margin)
+        x1, y1, x2, y2 = crop
+        with stage(stats, 'save'):
+            # new_im has had its side margins trimmed
+            text_im = new_im.crop((x1 - params.margin, y1, x2 - params.margin, y2))
+            text_im.save(out_path)
+    if params.verbose:
+        print('%s -> %s' % (path, out_path))
+    return crop
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+'''Speed and output regression checks for the two crop implementations.
+
+Usage:
+
+    ./crop_regression.py [options] [path/to/samples/*.jpg]
+
+Runs each crop_engine preset (sp_crop and crop_morphology) over every page
+(plus a set of synthetic pages generated on the fly with --synthetic N, so it
+works without any real scans), recording the time, peak numpy memory and crop
+box of each, and the IoU between the two presets' boxes.
+
+Save a run with --save baseline.json, and later runs with --baseline
+baseline.json will exit non-zero if either implementation has got slower by
+more than --max-slowdown, or moved any box below --min-iou of its baseline.
+'''
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from functools import partial
+from time import time
+
+import cv2
+import numpy as np
+
+import crop_engine
+from crop_benchmark import box_iou
+
+implementations = dict((name, partial(crop_engine.process_image, params=params))
+                       for name, params in crop_engine.presets.items())
+
+words = ["the", "pursuer", "defender", "Lord", "Ordinary", "interlocutor", "of", "and", "Session",
+         "petition", "answers", "for", "whereas", "Edinburgh", "condescendence", "to", "be"]
+
+
+def synthetic_page(seed, width=2400, height=3600):
+    """A fake scanned page: paper-ish background, a block of "text" lines
+    (sometimes two columns, sometimes a printed border), noise and specks.
+    Every 7th page is a blank verso."""
+    rng = np.random.RandomState(seed)
+    page = np.full((height, width, 3), 225, dtype=np.uint8)
+    page += rng.randint(0, 20, (height, width, 1)).astype(np.uint8)
+    if seed % 7 == 6:
+        return page
+
+    columns = 2 if rng.rand() < 0.3 else 1
+    x0, y0 = rng.randint(150, 400), rng.randint(150, 500)
+    x1, y1 = width - rng.randint(150, 400), height - rng.randint(200, 600)
+    if rng.rand() < 0.3:
+        cv2.rectangle(page, (x0 - 60, y0 - 60), (x1 + 60, y1 + 60), (40, 40, 40), 4)
+    col_w = (x1 - x0) // columns
+    line_h = rng.randint(45, 80)
+    for col in range(columns):
+        for y in range(y0 + line_h, y1, line_h):
+            x = x0 + col * col_w
+            while True:
+                word = words[rng.randint(len(words))]
+                (w, _), _ = cv2.getTextSize(word, cv2.FONT_HERSHEY_COMPLEX, line_h / 45.0, 2)
+                if x + w > x0 + (col + 1) * col_w - 40:
+                    break
+                cv2.putText(page, word, (x, y), cv2.FONT_HERSHEY_COMPLEX, line_h / 45.0, (35, 30, 30), 2)
+                x += w + rng.randint(15, 35)
+    for _ in range(rng.randint(0, 12)):
+        cv2.circle(page, (rng.randint(width), rng.randint(height)), rng.randint(2, 8), (60, 60, 60), -1)
+    return page
+
+
+def generate_pages(directory, count):
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, "synthetic-%03d.jpg" % i)
+        cv2.imwrite(path, synthetic_page(i))
+        paths.append(path)
+    return paths
+
+
+def run_one(process_image, path, out_path):
+    """Time one crop and measure its peak numpy/Python allocation."""
+    tracemalloc.start()
+    start = time()
+    try:
+        box = process_image(path, out_path)
+        error = None
+    except Exception as e:
+        box, error = None, str(e)
+    seconds = time() - start
+    peak_mb = tracemalloc.get_traced_memory()[1] / 1048576.0
+    tracemalloc.stop()
+    return {"box": [int(x) for x in box] if box is not None else None,
+            "seconds": round(seconds, 4), "peak_mb": round(peak_mb, 1), "error": error}
+
+
+def run_suite(files):
+    """Run every implementation over every file.
+
+    Returns {"pages": {name: {impl: result}}, "totals": {impl: {...}}}.
+    """
+    pages = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for i, path in enumerate(files):
+            name = os.path.basename(path)
+            pages[name] = {}
+            for impl, process_image in sorted(implementations.items()):
+                out_path = os.path.join(tmp_dir, "%s-%s.png" % (i, impl))
+                pages[name][impl] = run_one(process_image, path, out_path)
+            boxes = [pages[name][impl]["box"] for impl in sorted(implementations)]
+            pages[name]["iou"] = round(box_iou(*boxes), 4)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    totals = {}
+    for impl in implementations:
+        results = [page[impl] for page in pages.values()]
+        seconds = sum(r["seconds"] for r in results)
+        totals[impl] = {"pages": len(results),
+                        "seconds": round(seconds, 3),
+                        "pages_per_second": round(len(results) / seconds, 3) if seconds else None,
+                        "max_peak_mb": max([r["peak_mb"] for r in results] or [0]),
+                        "errors": len([r for r in results if r["error"]])}
+    ious = [page["iou"] for page in pages.values()]
+    totals["agreement"] = {"mean_iou": round(sum(ious) / len(ious), 4) if ious else None,
+                           "min_iou": min(ious) if ious else None}
+    return {"pages": pages, "totals": totals}
+
+
+def compare(run, baseline, max_slowdown=0.2, min_iou=0.98):
+    """List the ways run has regressed against baseline (empty if none)."""
+    problems = []
+    for impl in implementations:
+        old, new = baseline["totals"].get(impl), run["totals"][impl]
+        if not old or not old["pages_per_second"] or not new["pages_per_second"]:
+            continue
+        if new["pages_per_second"] < old["pages_per_second"] * (1 - max_slowdown):
+            problems.append("%s throughput %.3f pages/s, was %.3f" % (
+                impl, new["pages_per_second"], old["pages_per_second"]))
+        if new["errors"] > old["errors"]:
+            problems.append("%s errors %s, was %s" % (impl, new["errors"], old["errors"]))
+    for name, page in run["pages"].items():
+        if name not in baseline["pages"]:
+            continue
+        for impl in implementations:
+            old_box, new_box = baseline["pages"][name][impl]["box"], page[impl]["box"]
+            iou = box_iou(old_box, new_box)
+            if iou < min_iou:
+                problems.append("%s %s box %s, was %s (IoU %.3f)" % (name, impl, new_box, old_box, iou))
+    return problems
+
+
+def print_report(run):
+    for impl, totals in sorted(run["totals"].items()):
+        if impl == "agreement":
+            continue
+        print('%-16s %s pages, %.2fs per page, %.2f pages/s, peak %.1fMB, %s errors' % (
+            impl, totals["pages"], totals["seconds"] / max(totals["pages"], 1),
+            totals["pages_per_second"] or 0, totals["max_peak_mb"], totals["errors"]))
+    agreement = run["totals"]["agreement"]
+    if agreement["mean_iou"] is not None:
+        print('sp_crop vs crop_morphology box IoU: mean %.3f, min %.3f' % (
+            agreement["mean_iou"], agreement["min_iou"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Crop speed and output regression checks.")
+    parser.add_argument("files", nargs="*", help="sample pages, or a single quoted glob")
+    parser.add_argument("-s", "--synthetic", type=int, default=0,
+                        help="also generate and run this many synthetic pages")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    parser.add_argument("--max-slowdown", type=float, default=0.2,
+                        help="fail if pages/s drops by more than this fraction (default 0.2)")
+    parser.add_argument("--min-iou", type=float, default=0.98,
+                        help="fail if a box's IoU with its baseline is below this (default 0.98)")
+    args = parser.parse_args()
+
+    files = args.files
+    if len(files) == 1 and '*' in files[0]:
+        files = sorted(glob.glob(files[0]))
+    synth_dir = None
+    if args.synthetic:
+        synth_dir = tempfile.mkdtemp()
+        files = files + generate_pages(synth_dir, args.synthetic)
+    if not files:
+        print("Nothing to run - give some sample pages and/or --synthetic N")
+        sys.exit(1)
+
+    try:
+        run = run_suite(files)
+    finally:
+        if synth_dir:
+            shutil.rmtree(synth_dir)
+    print_report(run)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(run, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(run, json.load(f), args.max_slowdown, args.min_iou)
+        for problem in problems:
+            print("REGRESSION: %s" % problem)
+        if problems:
+            sys.exit(1)
+        print("No regressions against %s" % args.baseline)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+'''Per-stage timing (and optionally memory) for the crop pipeline.
+
+    from crop_stats import CropStats
+    stats = CropStats()
+    process_image(infile, outfile, stats=stats)
+    print(stats.as_dict())
+
+image_worker.py can push these records to the redis list "stats:image_worker"
+(see record_stats there, and record_memory for the peak memory). Run this file
+to summarise that list:
+
+    ./crop_stats.py [max_records]
+
+which prints the p50/p95 wall time and peak memory of every stage.
+
+The counts also say how much text a page seemed to have, see text_density().
+'''
+
+import json
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from time import time
+
+
+class CropStats(object):
+    """Wall time, and with track_memory the peak Python/numpy allocation, of
+    each stage of processing one image, plus any counters worth keeping."""
+
+    def __init__(self, path=None, track_memory=False):
+        self.path = path
+        self.track_memory = track_memory
+        self.stages = []  # (name, seconds, peak_mb)
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        tracing = self.track_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.track_memory:
+            tracemalloc.reset_peak()
+        start = time()
+        try:
+            yield
+        finally:
+            seconds = time() - start
+            peak_mb = None
+            if self.track_memory:
+                peak_mb = tracemalloc.get_traced_memory()[1] / 1048576.0
+                if tracing:
+                    tracemalloc.stop()
+            self.stages.append((name, seconds, peak_mb))
+
+    def count(self, name, value):
+        self.counts[name] = value
+
+    def total(self):
+        return sum(seconds for _, seconds, _ in self.stages)
+
+    def as_dict(self):
+        """A stage that ran more than once (e.g. decode, when a reduced decode
+        wasn't possible and the full one followed) gets its total time and its
+        highest peak."""
+        stages, peaks = {}, {}
+        for name, seconds, peak_mb in self.stages:
+            stages[name] = stages.get(name, 0.0) + seconds
+            if peak_mb is not None:
+                peaks[name] = max(peaks.get(name, peak_mb), peak_mb)
+        record = {"path": self.path,
+                  "total": round(self.total(), 4),
+                  "stages": dict((name, round(seconds, 4)) for name, seconds in stages.items()),
+                  "counts": self.counts}
+        if self.track_memory:
+            record["peak_mb"] = dict((name, round(mb, 1)) for name, mb in peaks.items())
+        return record
+
+
+def stage(stats, name):
+    """stats.stage(name), or a no-op if stats is None."""
+    if stats is None:
+        return _no_stats()
+    return stats.stage(name)
+
+
+@contextmanager
+def _no_stats():
+    yield
+
+
+def text_density(counts):
+    """The text-density metrics from a CropStats' counts: components, how
+    many blocks of text find_components found (0 for a page with no text,
+    which process_image doesn't save), and edge_frac, the fraction of the
+    page that has edges in it after border removal, on a fixed grid (see
+    crop_engine.edge_fraction) so it doesn't depend on the scan's size. A
+    page of text is around 0.05-0.2 whichever preset found it, and a blank
+    page with a few specks under 0.001.
+
+    Returns {"components", "edge_frac"}, or None if the page wasn't analysed
+    (e.g. its box came from the crop cache).
+    """
+    if "edge_frac" not in counts:
+        return None
+    return {"components": counts["components"], "edge_frac": counts["edge_frac"]}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+def summarise(records):
+    """p50/p95 of each stage's time (and peak memory where recorded) over a
+    list of CropStats.as_dict() records.
+
+    Returns {stage: {"n", "p50", "p95", "mean", "p50_mb", "p95_mb"}}.
+    """
+    times, mems = {}, {}
+    for record in records:
+        for name, seconds in list(record["stages"].items()) + [("total", record["total"])]:
+            times.setdefault(name, []).append(seconds)
+        for name, mb in record.get("peak_mb", {}).items():
+            if mb is not None:
+                mems.setdefault(name, []).append(mb)
+    summary = {}
+    for name, values in times.items():
+        summary[name] = {"n": len(values),
+                         "p50": percentile(values, 50),
+                         "p95": percentile(values, 95),
+                         "mean": sum(values) / len(values)}
+        if name in mems:
+            summary[name]["p50_mb"] = percentile(mems[name], 50)
+            summary[name]["p95_mb"] = percentile(mems[name], 95)
+    return summary
+
+
+def print_summary(summary):
+    total = summary.get("total", {}).get("mean") or 1
+    print('%-16s %6s %8s %8s %7s %9s' % ("stage", "n", "p50 s", "p95 s", "% time", "p95 MB"))
+    for name, s in sorted(summary.items(), key=lambda item: -item[1]["mean"]):
+        print('%-16s %6s %8.3f %8.3f %6.1f%% %9s' % (
+            name, s["n"], s["p50"], s["p95"], 100.0 * s["mean"] / total,
+            "%.1f" % s["p95_mb"] if "p95_mb" in s else "-"))
+
+
+if __name__ == '__main__':
+    from redis import Redis
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    r = Redis()
+    records = [json.loads(item) for item in r.lrange("stats:image_worker", 0, limit - 1)]
+    if not records:
+        print("No stats recorded yet - set record_stats in image_worker.py")
+        sys.exit(1)
+    print_summary(summarise(records))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+'''Time the deborder engines in sp_crop against each other.
+
+Usage:
+
+    ./deborder_benchmark.py [path/to/image.jpg] [repeats]
+
+Runs sp_crop.deborder with every engine over the Canny edges of the image
+(or a synthetic 6000x4000 edge map if no image is given), checks that each
+one gives exactly the same result as the original scipy rank filters, and
+prints the best time of each.
+'''
+
+import sys
+from time import time
+
+import cv2
+import numpy as np
+
+from sp_crop import deborder
+
+engines = ['scipy', 'opencv', 'cumsum']
+
+
+def load_edges(path=None):
+    if path is None:
+        # roughly the density of a page of text after Canny
+        rng = np.random.RandomState(0)
+        return 255 * (rng.rand(6000, 4000) < 0.05).astype(np.uint8)
+    gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    _, thresh = cv2.threshold(gray, 120, 255, cv2.THRESH_BINARY_INV)
+    return 255 * (cv2.Canny(thresh, 100, 200) > 0).astype(np.uint8)
+
+
+def time_engine(edges, engine, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time()
+        result = deborder(edges, engine)
+        taken = time() - start
+        if best is None or taken < best:
+            best = taken
+    return result, best
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    edges = load_edges(path)
+    print('%s x %s edge map, best of %s' % (edges.shape[1], edges.shape[0], repeats))
+
+    reference, base_time = time_engine(edges, 'scipy', repeats)
+    failed = False
+    for engine in engines:
+        result, taken = time_engine(edges, engine, repeats)
+        same = np.array_equal(result, reference)
+        failed = failed or not same
+        print('%-8s %.3fs  %.1fx  %s' % (engine, taken, base_time / taken, 'identical' if same else 'DIFFERS'))
+    sys.exit(1 if failed else 0)
@@ -2,10 +2,17 @@
 '''Poll a redis queue for images to process, run the crop tool over them and write them to disk'''
 
 import os, sys, json
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from time import sleep
+from functools import partial
+from time import sleep, time
 from redis import Redis
 from sp_crop import process_image
+from crop_stats import CropStats, text_density
+from batch_crop import crop_one
+from work_queue import error_record, finish, worker_queues, renew_lease, reap, pop, take, record_density
 #from logging import Logger
 
 r = Redis()
@@ -25,90 +32,240 @@ if len(sys.argv) > 1 and sys.argv[1] == "-n" and int(sys.argv[2]) > 0:
 else:
     worker_id = ""
 
-status = "status:image_worker" + worker_id
-pid = "pid:image_worker" + worker_id
+worker = "image_worker" + worker_id
+status = "status:" + worker
+pid = "pid:" + worker
+# our items in progress go on our own list, images:in_progress:<worker>
+queues = worker_queues(queues, worker)
 
 wait_seconds =15 # How long to sleep for if no items in the queue
 wait_modifier = 1 # Multiplier for wait_seconds if consecutive polls are empty
 wait_maxseconds = 900 # What stage to stop increasing the wait time
 exit_when_empty = False
+max_dim = None # Find the crop box on a copy shrunk to this many px on its longest side (the crop itself is always cut
+               # at full resolution). None analyses at full resolution, as sp_crop always has
+fast_decode = False # With max_dim, decode JPEGs for the analysis at reduced size, straight to grayscale
+mmap_tiff = False # With max_dim, read uncompressed TIFFs through a memory map rather than decoding them whole, so the
+                  # worker's peak memory doesn't grow with the size of the master
+record_stats = False # Push per-stage timings for each image to redis (summarise with crop_stats.py)
+record_memory = False # With record_stats, also record each stage's peak Python/numpy memory (the p95 MB column in
+                      # crop_stats.py). Tracing allocations slows the crop down
+stats_key = "stats:image_worker"
+stats_max = 10000 # How many stats records to keep
+density_key = "crop:density" # Hash to record each page's text density in (see crop_stats.text_density), by outfile,
+                             # for ocr_worker to skip blank pages (it removes each once the page is done). None
+                             # to not record it
+blocking_pop = True # Wait on the queue (up to wait_seconds at a time) with BRPOPLPUSH rather than polling and sleeping
+lease_seconds = 1800 # If we haven't been heard from in this long, other workers will requeue our items in progress.
+                     # Must be longer than wait_maxseconds and than any one item takes
+reap_seconds = 60 # How often to renew our lease and requeue the items of any workers whose leases have expired
+batch_size = 1 # How many items to take from the queue at a time. They're moved to in progress together (by one Lua
+               # script) and written to complete/errors together, saving redis round trips on small jobs
+concurrency = 1 # Items in flight at once. Above 1, crops run in a pool of this many processes and the redis
+                # bookkeeping runs on an asyncio loop, so one worker can keep every core busy
+
+
+def check_item(json_item):
+    """Some basic checks on an item from the queue. If any fail, the item should go to the error queue and
+    some other poor bugger can deal with it.
+
+    Returns (item, error), where error is None or the record to push to the error queue.
+    """
+    # Firstly, can we reserialise the data from redis?
+    try:
+        item = json.loads(json_item)
+    except Exception as e:
+        return None, error_record("Could not load item dictionary from redis: %s"%e, json_item)
+    # Do we have the two bits of data we need?
+    if not item["infile"] or not item["outfile"]:
+        # Well, this is awkward! If I'm the only one populating the queue, I would hope that we should
+        # never end up here unless I've done something monumentally stupid, but better safe than sorry!
+        return item, error_record("Missing in or out file name(s)", item)
+    # Does the desired input file exist?
+    if not os.path.isfile(item["infile"]):
+        return item, error_record("Input file does not exist", item)
+    # Does the proposed output file exist? If so, and the overwrite flag is not set, it's a problem!
+    if os.path.isfile(item["outfile"]) and "overwrite" not in item:
+        return item, error_record("Output file exists and overwrite flag not set", item)
+    return item, None
+
+
+def work_on(json_item, pipe):
+    """Check and crop one item, queueing up its stats (if record_stats) and text density on pipe.
+
+    Returns None if it worked, or the record to push to the error queue.
+    """
+    item, error = check_item(json_item)
+    if error is not None:
+        return error
+    # ok, so at this point everything should be cool, let's try and process the image
+    try:
+        #print("Calling the image processor...")
+        if batch_size == 1:
+            r.set(status,"%s: Processing %s"%(datetime.now().strftime("%d/%m/%y %H:%M:%S"),item["infile"]))
+        stats = CropStats(item["infile"], track_memory=record_stats and record_memory) \
+            if record_stats or density_key else None
+        process_image(item["infile"], item["outfile"], max_dim=max_dim, fast_decode=fast_decode, mmap_tiff=mmap_tiff,
+                      stats=stats)
+        if stats is not None:
+            record_stats_and_density(pipe, item, stats.as_dict())
+        # if this didn't error out to the except block, we can assume process complete
+        return None
+    except Exception as e:
+        # something went wrong with image processing
+        return error_record(str(e), item)
+
+
+def record_stats_and_density(pipe, item, record):
+    """Queue up pushing a CropStats record (if record_stats) and storing the page's text density on pipe."""
+    if record_stats:
+        pipe.lpush(stats_key, json.dumps(record))
+        pipe.ltrim(stats_key, 0, stats_max - 1)
+    density = text_density(record["counts"])
+    if density_key and density is not None:
+        record_density(pipe, density_key, item["outfile"], density)
+
+
+async def process_item(ar, pool, json_item):
+    """Check, crop (in the process pool) and file away one item, same as the loop below does."""
+    item, error = check_item(json_item)
+    pipe = ar.pipeline()
+    if error is None:
+        await ar.set(status, "%s: Processing %s"%(datetime.now().strftime("%d/%m/%y %H:%M:%S"),item["infile"]))
+        result = await asyncio.get_running_loop().run_in_executor(
+            pool, crop_one, (partial(process_image, max_dim=max_dim, fast_decode=fast_decode, mmap_tiff=mmap_tiff),
+                             item["infile"], item["outfile"], record_stats or density_key,
+                             record_stats and record_memory))
+        if result["status"] == "error":
+            error = error_record(result["error"], item)
+        elif "stats" in result:
+            record_stats_and_density(pipe, item, result["stats"])
+    # write to complete (or errors), remove from in progress
+    await finish(pipe, queues, json_item, error).execute()
+
+
+async def run_concurrent():
+    """Keep up to concurrency items in flight until the queue runs dry (if exit_when_empty) or forever."""
+    from redis import asyncio as aioredis
+    ar = aioredis.Redis()
+    # fork, so the pool's processes don't import this script afresh (as spawn and forkserver do) and start a whole
+    # worker of their own from its module level code
+    pool = ProcessPoolExecutor(concurrency, mp_context=multiprocessing.get_context("fork"))
+    in_flight = set()
+    next_item = None # pending pop from the queue, at most one at a time
+    queue_empty = False
+    current_wait = wait_seconds
+    last_reap = time()
+    try:
+        while True:
+            # Every so often, renew our lease and requeue the items of any workers that have died
+            if time() - last_reap > reap_seconds:
+                await renew_lease(ar.pipeline(), queues, worker, lease_seconds).execute()
+                await reap(ar, queues)
+                last_reap = time()
+            if next_item is None and len(in_flight) < concurrency and not queue_empty:
+                if blocking_pop:
+                    next_item = asyncio.ensure_future(ar.brpoplpush(queues["read"], queues["work"],
+                                                                    timeout=wait_seconds))
+                else:
+                    next_item = asyncio.ensure_future(ar.rpoplpush(queues["read"], queues["work"]))
+            if next_item is None and not in_flight:
+                # no items, nothing running, wait and try again
+                if exit_when_empty:
+                    await ar.set(status, "%s: Terminated due to empty queue"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
+                    return
+                await ar.set(status, "%s: No items in queue, sleeping for %ss" %(datetime.now().strftime("%d/%m/%y %H:%M:%S"), current_wait))
+                await asyncio.sleep(current_wait)
+                current_wait = min(current_wait * wait_modifier, wait_maxseconds)
+                queue_empty = False
+                continue
+            # Wait for a new item or for something to finish, whichever is first
+            waiting = set(in_flight)
+            if next_item is not None:
+                waiting.add(next_item)
+            done, _ = await asyncio.wait(waiting, timeout=reap_seconds, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is next_item:
+                    next_item = None
+                    json_item = task.result()
+                    if json_item:
+                        current_wait = wait_seconds
+                        json_items = [json_item]
+                        if batch_size > 1 and len(in_flight) + 1 < concurrency:
+                            # fill the rest of the free slots in one go
+                            json_items += await take(ar, queues, min(batch_size, concurrency - len(in_flight)) - 1)
+                        for json_item in json_items:
+                            in_flight.add(asyncio.ensure_future(process_item(ar, pool, json_item)))
+                    elif not blocking_pop:
+                        # don't poll again until something finishes (or we've slept)
+                        queue_empty = True
+                    elif not in_flight:
+                        # the blocking pop timed out with nothing to do
+                        if exit_when_empty:
+                            await ar.set(status, "%s: Terminated due to empty queue"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
+                            return
+                        await ar.set(status, "%s: No items in queue, waiting"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
+                else:
+                    in_flight.discard(task)
+                    task.result()
+                    queue_empty = False
+                    if not in_flight:
+                        await ar.set(status, "%s: Waiting for work"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
+    finally:
+        if next_item is not None:
+            next_item.cancel()
+        pool.shutdown()
+        await ar.aclose()
+
 
 # write pid to redis
 r.set(pid,os.getpid())
 
+# put back anything an earlier run of this worker left in progress
+reap(r, queues, worker)
+renew_lease(r, queues, worker, lease_seconds)
+last_reap = time()
+
+if concurrency > 1:
+    asyncio.run(run_concurrent())
+    sys.exit(1)
+
 current_wait = wait_seconds
 should_exit = False
 while not should_exit:
-    # See if we can pop an item from the queue!
-    json_item = r.rpoplpush(queues["read"],queues["work"])
-    if json_item:
+    # Every so often, renew our lease and requeue the items of any workers that have died
+    if time() - last_reap > reap_seconds:
+        renew_lease(r, queues, worker, lease_seconds)
+        reap(r, queues)
+        last_reap = time()
+    # See if we can pop some items from the queue!
+    json_items = pop(r, queues, batch_size, wait_seconds if blocking_pop else None)
+    if json_items:
         # Ok, lets get to work :D
-        #print("Item found: %s"%json_item)
+        #print("Items found: %s"%json_items)
 
         # Reset the wait timer
         current_wait = wait_seconds
-        # Some basic checks, if any fail, push the item to the error queue and let some other poor bugger deal with it
-        # Firstly, can we reserialise the data from redis?
-        try:
-            item = json.loads(json_item)
-        except Exception as e:
-            error = {"error": "Could not load item dictionary from redis: %s"%e,
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": json_item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            continue
-        # Do we have the two bits of data we need?
-        if not item["infile"] or not item["outfile"]:
-            # Well, this is awkward! If I'm the only one populating the queue, I would hope that we should
-            # never end up here unless I've done something monumentally stupid, but better safe than sorry!
-            error = {"error":"Missing in or out file name(s)",
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            continue
-        # Does the desired input file exist?
-        if not os.path.isfile(item["infile"]):
-            error = {"error": "Input file does not exist",
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            continue
-        # Does the proposed output file exist? If so, and the overwrite flag is not set, it's a problem!
-        if os.path.isfile(item["outfile"]) and "overwrite" not in item:
-            error = {"error": "Output file exists and overwrite flag not set",
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            continue
-        # ok, so at this point everything should be cool, let's try and process the image
-        try:
-            #print("Calling the image processor...")
-            r.set(status,"%s: Processing %s"%(datetime.now().strftime("%d/%m/%y %H:%M:%S"),item["infile"]))
-            process_image(item["infile"], item["outfile"])
-            # if this didn't error out to the except block, we can assume process complete
-            # write to complete, remove from in progress
-            r.rpush(queues["write"], json_item)
-            r.lrem(queues["work"], json_item)
-            r.set(status, "%s: Waiting for work"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
-            #print("Done")
-            # all done, go to the top and start again!
-            continue
-        except Exception as e:
-            # something went wrong with image processing
-            error = {"error": str(e),
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            r.set(status, "%s: Waiting for work" % datetime.now().strftime("%d/%m/%y %H:%M:%S"))
+        if batch_size > 1:
+            r.set(status, "%s: Processing %s items"%(datetime.now().strftime("%d/%m/%y %H:%M:%S"), len(json_items)))
+        # Each item goes to complete or errors on its own merits, but they're all written (and removed from in
+        # progress) in one go at the end
+        pipe = r.pipeline()
+        for json_item in json_items:
+            finish(pipe, queues, json_item, work_on(json_item, pipe))
+        pipe.set(status, "%s: Waiting for work"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
+        pipe.execute()
+        #print("Done")
+        # all done, go to the top and start again!
+        continue
     else:
         if exit_when_empty:
             r.set(status, "%s: Terminated due to empty queue"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
             sys.exit(1)
+        if blocking_pop:
+            # the pop has already waited for wait_seconds, just show we're still alive
+            r.set(status, "%s: No items in queue, waiting"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
+            continue
         # no item, wait and try again
         #print("No items in queue, sleeping for %ss"%current_wait)
         r.set(status, "%s: No items in queue, sleeping for %ss" %(datetime.now().strftime("%d/%m/%y %H:%M:%S"), current_wait))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+'''Compare ways of OCRing a page in several languages.
+
+Usage:
+
+    ./ocr_benchmark.py [options] 'path/to/crops/*.png'
+
+Runs each page through:
+
+    per-dict       what ocr_worker does by default: the decoded page handed
+                   to Tesseract once per language
+    shared         decoded and prepared once (see ocr_engine.prepare),
+                   shared by every language
+    preprocessed   as shared, but grayscaled, deskewed and binarised first
+    combined       one pass with a combined model, e.g. eng+enm
+    combined+pre   combined, preprocessed
+
+and prints the time per page of each, and how close each one's text is to
+per-dict's text for the first language (word level similarity, 1.0 being
+the same).
+'''
+
+import argparse
+import glob
+import sys
+from difflib import SequenceMatcher
+from time import time
+
+from PIL import Image
+
+from ocr_engine import get_engine, preprocess
+
+modes = ["per-dict", "shared", "preprocessed", "combined", "combined+pre"]
+
+
+def run_mode(engine, mode, image, dicts):
+    """OCR image one way. Returns {lang: text}."""
+    if mode in ("preprocessed", "combined+pre"):
+        image = preprocess(image)
+    if mode != "per-dict":
+        image = engine.prepare(image)
+    if mode.startswith("combined"):
+        dicts = ["+".join(dicts)]
+    return dict((lang, engine.text(image, lang)) for lang in dicts)
+
+
+def similarity(text1, text2):
+    return SequenceMatcher(None, text1.split(), text2.split(), autojunk=False).ratio()
+
+
+def run_benchmark(engine, files, dicts):
+    """Returns {mode: (seconds per page, mean similarity to per-dict)}."""
+    # load every model before timing anything
+    blank = Image.new("L", (100, 100), 255)
+    for lang in dicts + ["+".join(dicts)]:
+        engine.text(blank, lang)
+
+    times = dict((mode, 0.0) for mode in modes)
+    scores = dict((mode, []) for mode in modes)
+    for path in files:
+        image = Image.open(path)
+        image.load()
+        texts, taken = {}, {}
+        for mode in modes:
+            start = time()
+            texts[mode] = run_mode(engine, mode, image, dicts)
+            taken[mode] = time() - start
+            times[mode] += taken[mode]
+        reference = texts["per-dict"][dicts[0]]
+        for mode in modes:
+            text = list(texts[mode].values())[0] if mode.startswith("combined") else texts[mode][dicts[0]]
+            scores[mode].append(similarity(reference, text))
+        print('%s: %s' % (path, ", ".join("%s %.2fs" % (mode, taken[mode]) for mode in modes)))
+    n = max(len(files), 1)
+    return dict((mode, (times[mode] / n, sum(scores[mode]) / n)) for mode in modes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare ways of OCRing a page in several languages.")
+    parser.add_argument("files", nargs="+", help="page images, or a single quoted glob")
+    parser.add_argument("-e", "--engine", default="tesserocr", help="OCR engine (see ocr_engine.py)")
+    parser.add_argument("-d", "--dicts", default="eng,enm", help="comma separated languages (default eng,enm)")
+    parser.add_argument("-t", "--tessdata", help="where to find the traineddata")
+    args = parser.parse_args()
+
+    files = args.files
+    if len(files) == 1 and '*' in files[0]:
+        files = sorted(glob.glob(files[0]))
+    if not files:
+        print("No pages to OCR")
+        sys.exit(1)
+
+    engine = get_engine(args.engine, tessdata_path=args.tessdata)
+    results = run_benchmark(engine, files, args.dicts.split(","))
+    base = results["per-dict"][0]
+    print('----')
+    print('%s pages, %s' % (len(files), args.dicts))
+    for mode in modes:
+        seconds, score = results[mode]
+        print('%-14s %.2fs per page (%.2fx), similarity %.3f' % (mode, seconds, base / max(seconds, 1e-9), score))
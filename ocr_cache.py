@@ -0,0 +1,71 @@
+'''Persistent store of OCR results, so a page only goes through Tesseract once.
+
+Results are keyed by a hash of the page image file's contents, the language
+and the settings that produced them (see ocr_engine's cache_key()), so a page
+that's requeued, replayed or re-run with the same settings is a hit wherever
+its file now lives, and changing engine, Tesseract version or settings misses.
+
+    from ocr_cache import OcrCache
+
+    cache = OcrCache("ocr_cache.sqlite")
+    key = cache.key("page.crop.png", "eng", engine.cache_key())
+    hit, text, lines = cache.get(key)
+    if not hit:
+        text, lines = engine.read(image, "eng")
+        cache.put(key, text, lines)
+'''
+
+import json
+import sqlite3
+
+from crop_cache import file_hash
+
+
+class OcrCache(object):
+    """OCR text (and lines, see ocr_engine.read) stored in a small SQLite database.
+
+    The connection is opened on first use, and should only be used from the
+    thread that opened it.
+    """
+
+    def __init__(self, db_path="ocr_cache.sqlite"):
+        self.db_path = db_path
+        self._conn = None
+
+    def __getstate__(self):
+        return {"db_path": self.db_path, "_conn": None}
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, timeout=30)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS ocr "
+                               "(hash TEXT, lang TEXT, params TEXT, text TEXT, lines TEXT, "
+                               "PRIMARY KEY (hash, lang, params))")
+            self._conn.commit()
+        return self._conn
+
+    def key(self, path, lang, params, digest=None):
+        """Cache key for the file at path read in lang with the params dict.
+        Pass digest (its file_hash) if it's already known, to save hashing the
+        file again for every lang."""
+        return digest or file_hash(path), lang, json.dumps(params, sort_keys=True)
+
+    def get(self, key):
+        """Returns (hit, text, lines); lines is None if they weren't stored."""
+        row = self.conn.execute("SELECT text, lines FROM ocr WHERE hash = ? AND lang = ? AND params = ?",
+                                key).fetchone()
+        if row is None:
+            return False, None, None
+        return True, row[0], json.loads(row[1]) if row[1] is not None else None
+
+    def put(self, key, text, lines=None):
+        lines = json.dumps(lines, separators=(",", ":")) if lines is not None else None
+        self.conn.execute("INSERT OR REPLACE INTO ocr (hash, lang, params, text, lines) VALUES (?, ?, ?, ?, ?)",
+                          key + (text, lines))
+        self.conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,359 @@
+'''Tesseract engines for ocr_worker.py.
+
+    from ocr_engine import get_engine
+    engine = get_engine("tesserocr")
+    text = engine.text(Image.open("page.crop.png"), "eng")
+
+"pyocr" is how the worker has always done it: pyocr's first available tool,
+which for the tesseract command line means starting a new tesseract process
+(and loading its traineddata from disk) for every page and every language.
+
+"tesserocr" keeps one Tesseract instance per language loaded for as long as
+the worker runs and reuses it for every page, so a page only costs the
+recognition itself. It needs the tesserocr package, and the traineddata
+either in Tesseract's default location or in tessdata_path.
+
+Both use Tesseract's automatic page segmentation (pyocr's layout 3).
+
+A page going to several languages only needs decoding and preparing once:
+
+    image = engine.prepare(preprocess(Image.open(path)))
+    for lang in ("eng", "enm"):
+        text = engine.text(image, lang)
+
+or can be read in one pass with a combined model, engine.text(image, "eng+enm").
+See ocr_benchmark.py for how the options compare.
+
+engine.read(image, lang) gets the lines and words, with their boxes and
+confidences, from the same recognition as the text:
+
+    text, lines = engine.read(image, "eng")
+    # lines: [{"box": [x1, y1, x2, y2], "conf": 91.2, "text": "...",
+    #          "words": [["word", x1, y1, x2, y2, conf], ...]}, ...]
+
+Confidences are Tesseract's, 0-100, and a line's is the mean of its words'.
+The boxes are in the coordinates of the image read, so for a page
+preprocess() straightened, unrotate_lines() puts them back onto the page.
+
+engine.cache_key() is what identifies an engine's results for ocr_cache.py:
+its name, the Tesseract version and where the traineddata comes from.
+'''
+
+import os
+import threading
+from html.parser import HTMLParser
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def skew_angle(gray, max_angle=3.0, size=1000):
+    """Estimate the rotation (in degrees, as for cv2.getRotationMatrix2D)
+    that straightens the text on a grayscale page, by finding the one that
+    gives a small binarised copy the sharpest row projection profile (text
+    lines and the gaps between them line up with rows). Tries half, then
+    tenths of a degree, up to max_angle either way."""
+    scale = min(1.0, 1.0 * size / max(gray.shape))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, ink = cv2.threshold(small, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    ink = ink.astype(np.float32)
+    h, w = ink.shape
+
+    def sharpness(angle):
+        m = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), angle, 1)
+        rows = cv2.warpAffine(ink, m, (w, h)).sum(axis=1)
+        return np.var(rows)
+
+    best = max(np.arange(-max_angle, max_angle + 0.5, 0.5), key=sharpness)
+    return max(np.arange(best - 0.5, best + 0.55, 0.1), key=sharpness)
+
+
+def preprocess(image, binarise=True, deskew=True):
+    """Grayscale, straighten and (Otsu) binarise a page once, so every
+    language it's read in can share the result. Returns an 'L' Image, with
+    the angle it was turned by in its info["deskew"] if it was (see
+    unrotate_lines)."""
+    gray = np.asarray(image.convert("L"))
+    angle = None
+    if deskew:
+        angle = skew_angle(gray)
+        if abs(angle) >= 0.05:
+            h, w = gray.shape
+            m = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), angle, 1)
+            gray = cv2.warpAffine(gray, m, (w, h), flags=cv2.INTER_LINEAR, borderValue=255)
+        else:
+            angle = None
+    if binarise:
+        _, gray = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    out = Image.fromarray(gray)
+    out.info = dict(image.info)
+    if angle is not None:
+        out.info["deskew"] = float(angle)
+    return out
+
+
+def unrotate_lines(lines, angle, size):
+    """Put the boxes of lines (see read()) read from a page that preprocess()
+    turned by angle back into the page's own coordinates, size being its
+    (width, height). Each box becomes the bounds of where its corners go."""
+    width, height = size
+    m = cv2.invertAffineTransform(cv2.getRotationMatrix2D((width / 2.0, height / 2.0), angle, 1))
+
+    def unrotate(x1, y1, x2, y2):
+        corners = np.array([[x1, y1], [x2, y1], [x1, y2], [x2, y2]], dtype=np.float64)
+        back = corners.dot(m[:, :2].T) + m[:, 2]
+        (bx1, by1), (bx2, by2) = np.floor(back.min(axis=0)), np.ceil(back.max(axis=0))
+        return [int(max(bx1, 0)), int(max(by1, 0)), int(min(bx2, width)), int(min(by2, height))]
+
+    for line in lines:
+        line["box"] = unrotate(*line["box"])
+        for word in line["words"]:
+            word[1:5] = unrotate(*word[1:5])
+    return lines
+
+
+def line_record(box, words):
+    confs = [word[5] for word in words]
+    return {"box": box,
+            "conf": round(sum(confs) / len(confs), 1) if confs else None,
+            "text": " ".join(word[0] for word in words),
+            "words": words}
+
+
+def tsv_lines(tsv):
+    """Lines and words (see read()) from Tesseract's TSV output."""
+    lines = []
+    current = None
+    for row in tsv.splitlines():
+        cols = row.split("\t")
+        if len(cols) < 11 or not cols[0].isdigit():
+            continue  # the header, if there is one
+        level = int(cols[0])
+        left, top, width, height = [int(c) for c in cols[6:10]]
+        box = [left, top, left + width, top + height]
+        if level == 4:
+            current = []
+            lines.append((box, current))
+        elif level == 5 and current is not None and len(cols) > 11 and cols[11].strip():
+            current.append([cols[11], box[0], box[1], box[2], box[3], round(float(cols[10]), 1)])
+    return [line_record(box, words) for box, words in lines if words]
+
+
+class HocrParser(HTMLParser):
+    """Paragraphs of lines of words (see read()) from Tesseract's hOCR."""
+
+    LINE_CLASSES = {"ocr_line", "ocr_header", "ocr_footer", "ocr_caption", "ocr_textfloat"}
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.paragraphs = []
+        self.open_tags = []
+        self.word = None
+
+    @staticmethod
+    def title_props(title):
+        props = {}
+        for piece in title.split(";"):
+            piece = piece.split()
+            if piece:
+                props[piece[0]] = piece[1:]
+        return props
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        cls = attrs.get("class")
+        self.open_tags.append((tag, cls))
+        props = self.title_props(attrs.get("title", ""))
+        if cls == "ocr_par":
+            self.paragraphs.append([])
+        elif cls in self.LINE_CLASSES:
+            if not self.paragraphs:
+                self.paragraphs.append([])
+            self.paragraphs[-1].append(([int(v) for v in props["bbox"]], []))
+        elif cls in ("ocrx_word", "ocr_word") and self.paragraphs and self.paragraphs[-1]:
+            self.word = [u""] + [int(v) for v in props["bbox"]] + [round(float(props.get("x_wconf", [0])[0]), 1)]
+
+    def handle_startendtag(self, tag, attrs):
+        pass
+
+    def handle_endtag(self, tag):
+        while self.open_tags:
+            open_tag, cls = self.open_tags.pop()
+            if cls in ("ocrx_word", "ocr_word") and self.word is not None:
+                if self.word[0].strip():
+                    self.paragraphs[-1][-1][1].append(self.word)
+                self.word = None
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.word is not None:
+            self.word[0] += data
+
+
+def hocr_read(hocr):
+    """(text, lines) from Tesseract's hOCR output. The text is what
+    Tesseract's own text output would be: a line per row, a blank row
+    between paragraphs, and stripped as pyocr's TextBuilder does."""
+    parser = HocrParser()
+    parser.feed(hocr)
+    parser.close()
+    paragraphs = [[line_record(box, words) for box, words in paragraph if words]
+                  for paragraph in parser.paragraphs]
+    text = "\n\n".join("\n".join(line["text"] for line in paragraph) for paragraph in paragraphs if paragraph)
+    return text.strip(), [line for paragraph in paragraphs for line in paragraph]
+
+
+def read_builder(builders):
+    """A pyocr builder for read(): the hOCR LineBoxBuilder, but at
+    TextBuilder's layout and giving (text, lines) via hocr_read()."""
+
+    class ReadBuilder(builders.LineBoxBuilder):
+        def __init__(self):
+            super(ReadBuilder, self).__init__(tesseract_layout=3)
+
+        def read_file(self, file_descriptor):
+            return hocr_read(file_descriptor.read())
+
+        def get_output(self):
+            # libtesseract fills in self.lines rather than writing hOCR, and
+            # its TextBuilder has no blank lines between paragraphs either
+            lines = []
+            for line in self.lines:
+                words = []
+                for word in line.word_boxes:
+                    (x1, y1), (x2, y2) = word.position
+                    words.append([word.content, x1, y1, x2, y2, round(float(word.confidence), 1)])
+                (x1, y1), (x2, y2) = line.position
+                lines.append(line_record([x1, y1, x2, y2], words))
+            return "\n".join(line["text"] for line in lines), [line for line in lines if line["words"]]
+
+    return ReadBuilder
+
+
+class PyocrEngine(object):
+    """pyocr's first available tool, called afresh for every page."""
+
+    name = "pyocr"
+
+    def __init__(self, tessdata_path=None):
+        import pyocr
+        import pyocr.builders
+        self.builders = pyocr.builders
+        self.read_builder = read_builder(pyocr.builders)
+        if tessdata_path:
+            # picked up by the tesseract processes pyocr starts
+            os.environ["TESSDATA_PREFIX"] = tessdata_path
+        tools = pyocr.get_available_tools()
+        if not tools:
+            raise RuntimeError("No OCR tool found by pyocr")
+        self.tool = tools[0]
+        self.tessdata_path = tessdata_path
+
+    def cache_key(self):
+        return {"engine": self.name,
+                "tool": self.tool.get_name(),
+                "version": ".".join(str(v) for v in self.tool.get_version()),
+                "tessdata": self.tessdata_path}
+
+    def prepare(self, image):
+        """image decoded and in RGB, which pyocr's tools would convert it to
+        anyway, so each language's run (maybe in another thread) uses the
+        same pixels rather than reading the file again."""
+        if image.mode != "RGB":
+            return image.convert("RGB")
+        image.load()
+        return image
+
+    def text(self, image, lang):
+        return self.tool.image_to_string(image, lang=lang, builder=self.builders.TextBuilder())
+
+    def read(self, image, lang):
+        """(text, lines) from one run, via hOCR: the text is the same as text()'s."""
+        return self.tool.image_to_string(image, lang=lang, builder=self.read_builder())
+
+    def close(self):
+        pass
+
+
+class TesserocrEngine(object):
+    """A long lived tesserocr.PyTessBaseAPI per language (and per thread, as
+    an API can only do one thing at once), loaded on first use."""
+
+    name = "tesserocr"
+
+    def __init__(self, tessdata_path=None):
+        import tesserocr
+        self.tesserocr = tesserocr
+        self.tessdata_path = tessdata_path
+        self.local = threading.local()
+        self.all_apis = []
+
+    def cache_key(self):
+        return {"engine": self.name,
+                "version": self.tesserocr.tesseract_version().split("\n")[0],
+                "tessdata": self.tessdata_path}
+
+    def api(self, lang):
+        apis = getattr(self.local, "apis", None)
+        if apis is None:
+            apis = self.local.apis = {}
+        if lang not in apis:
+            if self.tessdata_path:
+                api = self.tesserocr.PyTessBaseAPI(path=self.tessdata_path, lang=lang)
+            else:
+                api = self.tesserocr.PyTessBaseAPI(lang=lang)
+            apis[lang] = api
+            self.all_apis.append(api)
+        return apis[lang]
+
+    def prepare(self, image):
+        """The raw pixels of image, so each language's SetImageBytes can use
+        the same buffer rather than each SetImage encoding it again."""
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+        bpp = len(image.mode)
+        dpi = image.info.get("dpi")
+        return image.tobytes(), image.size[0], image.size[1], bpp, image.size[0] * bpp, dpi
+
+    def text(self, image, lang):
+        api = self.set_image(image, lang)
+        # pyocr strips the text too
+        return api.GetUTF8Text().strip()
+
+    def read(self, image, lang):
+        """(text, lines) from one recognition: the text is the same as text()'s."""
+        api = self.set_image(image, lang)
+        api.Recognize()
+        return api.GetUTF8Text().strip(), tsv_lines(api.GetTSVText(0))
+
+    def set_image(self, image, lang):
+        """Hand image (a PIL Image, or what prepare() made of one) to the
+        API for lang, and return the API."""
+        api = self.api(lang)
+        if isinstance(image, tuple):
+            data, width, height, bpp, bpl, dpi = image
+            api.SetImageBytes(data, width, height, bpp, bpl)
+            if dpi:
+                api.SetSourceResolution(int(dpi[0]))
+        else:
+            api.SetImage(image)
+        return api
+
+    def close(self):
+        for api in self.all_apis:
+            api.End()
+        self.all_apis = []
+        self.local = threading.local()
+
+
+engines = {"pyocr": PyocrEngine, "tesserocr": TesserocrEngine}
+
+
+def get_engine(name="pyocr", **options):
+    """An engine by name, see engines. Raises an exception if it can't be
+    set up (e.g. its package or Tesseract isn't installed)."""
+    if name not in engines:
+        raise ValueError("Unknown OCR engine: %s" % name)
+    return engines[name](**options)
@@ -2,11 +2,17 @@
 '''Poll a redis queue for images to OCR, run them through tesseract and write the results to disk'''
 
 import os, sys, json, codecs
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from datetime import datetime
-from time import sleep
+from time import sleep, time
 from redis import Redis
 from PIL import Image
-import pyocr
+from ocr_engine import get_engine, preprocess, unrotate_lines
+from ocr_cache import OcrCache
+from crop_cache import file_hash
+from work_queue import error_record, finish, worker_queues, renew_lease, reap, pop, get_density, forget_density
+import xml_handler
 #from logging import Logger
 
 r = Redis()
@@ -27,130 +33,281 @@ else:
     worker_id = ""
 
 
-status = "status:ocr_worker" + worker_id
-pid = "pid:ocr_worker" + worker_id
+worker = "ocr_worker" + worker_id
+status = "status:" + worker
+pid = "pid:" + worker
+# our items in progress go on our own list, ocr:in_progress:<worker>
+queues = worker_queues(queues, worker)
 
 wait_seconds = 15 # How long to sleep for if no items in the queue
 wait_modifier = 1 # Multiplier for wait_seconds if consecutive polls are empty
 wait_maxseconds = 900 # What stage to stop increasing the wait time
 exit_when_empty = False
+blocking_pop = True # Wait on the queue (up to wait_seconds at a time) with BRPOPLPUSH rather than polling and sleeping
+batch_size = 1 # How many items to take from the queue at a time. They're moved to in progress together (by one Lua
+               # script) and written to complete/errors together, saving redis round trips on small jobs
+lease_seconds = 1800 # If we haven't been heard from in this long, other workers will requeue our items in progress.
+                     # Must be longer than wait_maxseconds and than any one item takes
+reap_seconds = 60 # How often to renew our lease and requeue the items of any workers whose leases have expired
 
 tesseract_dicts = ["eng", "enm"]
+ocr_engine = "pyocr" # "tesserocr" keeps a Tesseract instance per language loaded between pages (see ocr_engine.py),
+                     # "pyocr" runs pyocr's tool (e.g. a new tesseract process) for every page and language
+combine_dicts = False # Read the page once with all of the item's dicts combined (e.g. eng+enm), writing one
+                      # -eng+enm-text.txt, rather than once per dict. See ocr_benchmark.py
+preprocess_pages = False # Grayscale, deskew and binarise each page once up front, shared by all its dicts
+ocr_threads = 1 # How many recognitions (pages x dicts) to run at once, in a thread pool - Tesseract releases the GIL
+                # while it works. The pages come from one batch, so raise batch_size to match
+omp_thread_limit = None # OMP_THREAD_LIMIT, the threads Tesseract may use inside each recognition. None leaves it alone
+                        # with ocr_threads = 1, and otherwise shares the cores out so the two don't oversubscribe them
+ocr_boxes = False # Also write each text line's box, confidence and words (with theirs) to -boxes.jsonl, one JSON
+                  # object per line, from the same recognition as the text. See ocr_engine.read
+tessdata_path = None # Where Tesseract should find the traineddata, if not its default
+ocr_cache_path = None # SQLite file of OCR results keyed by page content, dict and settings (see ocr_cache.py), so
+                      # a requeued or re-run page is written out from there without OCRing it again. None for no cache
+density_key = "crop:density" # Where image_worker records each cropped page's text density (see crop_stats.text_density)
+min_edge_frac = None # Pages the crop found no text on aren't OCRed (their outputs are written empty instead), and
+                     # nor are those with less edge than this fraction of them (see crop_stats.text_density). None
+                     # to only skip the ones with no text, until it's been tuned on the collection's blank pages
+xml_log = False # Log skipped pages to their item's XML record (see xml_handler.addlog), for items with a shelfmark,
+                # index and sequence
+
+
+def check_item(json_item):
+    """Some basic checks on an item from the queue. If any fail, the item should go to the error queue and
+    some other poor bugger can deal with it.
+
+    Returns (item, error), where error is None or the record to push to the error queue.
+    """
+    # Firstly, can we reserialise the data from redis?
+    try:
+        item = json.loads(json_item)
+    except Exception as e:
+        return None, error_record("Could not load item dictionary from redis: %s"%e, json_item)
+    # Do we have the data we need?
+    if "infile" not in item or "outpath" not in item:
+        # Well, this is awkward! If I'm the only one populating the queue, I would hope that we should
+        # never end up here unless I've done something monumentally stupid, but better safe than sorry!
+        return item, error_record("Missing required data", item)
+    # Does the desired input file exist? (The crop doesn't save one for a page with no text)
+    if not os.path.isfile(item["infile"]) and skip_reason(item) is None:
+        return item, error_record("Input file does not exist", item)
+    # Does the proposed output directory exist?
+    if not os.path.isdir(item["outpath"]):
+        return item, error_record("Output path is not a directory", item)
+    if "dicts" not in item: item["dicts"] = tesseract_dicts
+    # Is the proposed list of tesseract dictionaries actually a list?
+    if not isinstance(item["dicts"], list):
+        return item, error_record("Tesseract dictionaries list is not actually a list!", item)
+    return item, None
+
+
+def skip_reason(item):
+    """Why item's page shouldn't be OCRed, going by the text density the crop stage recorded for it, or None if it
+    should (including if nothing was recorded)."""
+    if density_key is None:
+        return None
+    if "density" not in item:
+        item["density"] = get_density(r, density_key, item["infile"])
+    density = item["density"]
+    if density is None:
+        return None
+    if density["components"] == 0:
+        return "no text found by the crop"
+    if min_edge_frac is not None and density["edge_frac"] < min_edge_frac:
+        return "edge fraction %s below %s" % (density["edge_frac"], min_edge_frac)
+    return None
+
+
+def log_skip(item, reason):
+    """Record that item's page wasn't OCRed in its XML record, if xml_log and the item says where that is. If that
+    fails it's only printed, as the item itself has worked."""
+    if not xml_log or not all(key in item for key in ("shelfmark", "index", "sequence")):
+        return
+    # (they may well have come through JSON as numbers)
+    shelfmark, index = str(item["shelfmark"]), str(item["index"])
+    try:
+        with xml_handler.locked(shelfmark, index):
+            tree = xml_handler.gettree(shelfmark, index)
+            xml_handler.addlog(tree, str(item["sequence"]), worker, "OCR skipped, blank page (%s)" % reason)
+            xml_handler.writetree(shelfmark, index, tree)
+    except Exception as e:
+        print("Could not log skipping %s to its XML record: %s" % (item["infile"], e))
+
+
+def load_item(json_item):
+    """Check an item, write out empty outputs if it's a blank page (see skip_reason) or any of its dicts that are in
+    the ocr_cache, and get its page ready for Tesseract if there are any left.
+
+    Returns (item, image, dicts, keys, error): the dicts still to OCR, their cache keys ({} with no cache), and error,
+    None or the record to push to the error queue.
+    """
+    item, error = check_item(json_item)
+    if error is not None:
+        return item, None, [], {}, error
+    # ok, so at this point everything should be cool, let's try and process the image
+    try:
+        if batch_size == 1:
+            r.set(status, "%s: Processing %s"%(datetime.now().strftime("%d/%m/%y %H:%M:%S"),item["infile"]))
+        # if no dictionaries specified, use all of them!
+        if len(item["dicts"]) == 0:
+            dicts = tesseract_dicts
+        else:
+            dicts = item["dicts"]
+        if combine_dicts:
+            dicts = ["+".join(dicts)]
+
+        reason = skip_reason(item)
+        if reason is not None:
+            for dict in dicts:
+                write_outputs(item, dict, "", [])
+            log_skip(item, reason)
+            return item, None, [], {}, None
+
+        keys = {}
+        if ocr_cache is not None:
+            digest = file_hash(item["infile"])
+            to_ocr = []
+            for dict in dicts:
+                keys[dict] = ocr_cache.key(item["infile"], dict, cache_params, digest)
+                hit, image_text, lines = ocr_cache.get(keys[dict])
+                if hit:
+                    write_outputs(item, dict, image_text, lines)
+                else:
+                    to_ocr.append(dict)
+            dicts = to_ocr
+            if not dicts:
+                return item, None, [], keys, None
+
+        image = Image.open(item["infile"])
+        if preprocess_pages:
+            image = preprocess(image)
+            if "deskew" in image.info:
+                # so the boxes can be put back onto the page as it was
+                item["deskew"] = image.info["deskew"], image.size
+        # decode (and convert) the page once for all the dicts
+        image = tess.prepare(image)
+        return item, image, dicts, keys, None
+    except Exception as e:
+        # something went wrong with image processing
+        return item, None, [], {}, error_record(str(e), item)
+
+
+def write_outputs(item, dict, image_text, lines=None):
+    """Write out a page's text in one dict, and its lines and words if ocr_boxes."""
+    inf = item["infile"].split("/")[-1]
+    if ocr_boxes:
+        with codecs.open(item["outpath"] + inf + "-" + dict + "-" + "boxes.jsonl", 'w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n")
+    with codecs.open(item["outpath"] + inf + "-" + dict + "-" + "text.txt", 'w', encoding='utf-8') as f:
+        f.write(image_text)
+
+
+def ocr_page(item, image, dict):
+    """OCR one page in one dict and write it out. Runs in the ocr_pool.
+
+    Returns (text, lines), lines being None unless ocr_boxes."""
+    #print("Running OCR...")
+    if ocr_boxes:
+        image_text, lines = tess.read(image, dict)
+        if "deskew" in item:
+            lines = unrotate_lines(lines, *item["deskew"])
+    else:
+        image_text, lines = tess.text(image, dict), None
+    write_outputs(item, dict, image_text, lines)
+    return image_text, lines
+
+
+def work_on(json_items):
+    """Check and OCR a batch of items, with every page and dict of them going to the ocr_pool at once.
+
+    Returns [(json_item, error)], where error is None if the item worked, or the record to push to the error queue.
+    """
+    results = []
+    jobs = []
+    for json_item in json_items:
+        item, image, dicts, keys, error = load_item(json_item)
+        results.append([json_item, error])
+        for dict in dicts:
+            jobs.append((results[-1], item, keys.get(dict), ocr_pool.submit(ocr_page, item, image, dict)))
+    for result, item, key, job in jobs:
+        try:
+            image_text, lines = job.result()
+            # (sqlite connections belong to one thread, so the cache is only used from this one)
+            if key is not None:
+                ocr_cache.put(key, image_text, lines)
+        except Exception as e:
+            # something went wrong with image processing (only the first problem with an item is kept)
+            if result[1] is None:
+                result[1] = error_record(str(e), item)
+    return [tuple(result) for result in results]
 
 
 # write PID to redis
 r.set(pid,os.getpid())
 
-# initialise tesseract
+# initialise tesseract. OpenMP reads its thread limit once, when Tesseract is loaded, so set it first
+if omp_thread_limit is None and ocr_threads > 1:
+    omp_thread_limit = max(1, cpu_count() // ocr_threads)
+if omp_thread_limit:
+    os.environ["OMP_THREAD_LIMIT"] = str(omp_thread_limit)
+ocr_pool = ThreadPoolExecutor(ocr_threads)
 try:
-    tess = pyocr.get_available_tools()[0]
+    tess = get_engine(ocr_engine, tessdata_path=tessdata_path)
 except Exception as e:
     r.set(status,"%s: Terminated with fatal error - No Tesseract found! - %s"%(datetime.now().strftime("%d/%m/%y %H:%M:%S"),e))
     #print("Fatal Error - No Tesseract found!")
     #print(e)
     sys.exit(1)
+ocr_cache = OcrCache(ocr_cache_path) if ocr_cache_path else None
+# Everything besides the page and dict that changes what comes out. Bump "format" if what's stored changes
+cache_params = dict(tess.cache_key(), preprocess=preprocess_pages, boxes=ocr_boxes, format=3) if ocr_cache else None
+
+# put back anything an earlier run of this worker left in progress
+reap(r, queues, worker)
+renew_lease(r, queues, worker, lease_seconds)
+last_reap = time()
 
 current_wait = wait_seconds
 should_exit = False
 while not should_exit:
-    # See if we can pop an item from the queue!
-    json_item = r.rpoplpush(queues["read"],queues["work"])
-    if json_item:
+    # Every so often, renew our lease and requeue the items of any workers that have died
+    if time() - last_reap > reap_seconds:
+        renew_lease(r, queues, worker, lease_seconds)
+        reap(r, queues)
+        last_reap = time()
+    # See if we can pop some items from the queue!
+    json_items = pop(r, queues, batch_size, wait_seconds if blocking_pop else None)
+    if json_items:
         # Ok, lets get to work :D
-        #print("Item found: %s"%json_item)
+        #print("Items found: %s"%json_items)
 
         # Reset the wait timer
         current_wait = wait_seconds
-        # Some basic checks, if any fail, push the item to the error queue and let some other poor bugger deal with it
-        # Firstly, can we reserialise the data from redis?
-        try:
-            item = json.loads(json_item)
-        except Exception as e:
-            error = {"error": "Could not load item dictionary from redis: %s"%e,
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": json_item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            continue
-        # Do we have the data we need?
-        if "infile" not in item or "outpath" not in item:
-            # Well, this is awkward! If I'm the only one populating the queue, I would hope that we should
-            # never end up here unless I've done something monumentally stupid, but better safe than sorry!
-            error = {"error":"Missing required data",
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            continue
-        # Does the desired input file exist?
-        if not os.path.isfile(item["infile"]):
-            error = {"error": "Input file does not exist",
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            continue
-        # Does the proposed output directory exist?
-        if not os.path.isdir(item["outpath"]):
-            error = {"error": "Output path is not a directory",
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            continue
-        if "dicts" not in item: item["dicts"] = tesseract_dicts
-        # Is the proposed list of tesseract dictionaries actually a list?
-        if not isinstance(item["dicts"], list):
-            error = {"error": "Tesseract dictionaries list is not actually a list!",
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            continue
-        # ok, so at this point everything should be cool, let's try and process the image
-        try:
-            r.set(status, "%s: Processing %s"%(datetime.now().strftime("%d/%m/%y %H:%M:%S"),item["infile"]))
-            #print("Running OCR...")
-            # if no dictionaries specified, use all of them!
-            if len(item["dicts"]) == 0:
-                dicts = tesseract_dicts
-            else:
-                dicts = item["dicts"]
-
-            image = Image.open(item["infile"])
-            for dict in dicts:
-                image_text = tess.image_to_string(image, lang=dict, builder=pyocr.builders.TextBuilder())
-                #word_boxes = tess.image_to_string(image, lang=dict, builder=pyocr.builders.WordBoxBuilder())
-                #line_boxes = tess.image_to_string(image, lang=dict, builder=pyocr.builders.LineBoxBuilder())
-                inf = item["infile"].split("/")[-1]
-                with codecs.open(item["outpath"] + inf + "-" + dict + "-" + "text.txt", 'w', encoding='utf-8') as f:
-                    pyocr.builders.TextBuilder().write_file(f, image_text)
-                #with codecs.open(item["outpath"] + inf + "-" + dict + "-" + "words.txt", 'w', encoding='utf-8') as f:
-                #    pyocr.builders.WordBoxBuilder().write_file(f, word_boxes)
-                #with codecs.open(item["outpath"] + inf + "-" + dict + "-" + "lines.txt", 'w', encoding='utf-8') as f:
-                #    pyocr.builders.LineBoxBuilder().write_file(f,line_boxes)
-
-            #process_image(item["infile"], item["outfile"])
-            # if this didn't error out to the except block, we can assume process complete
-            # write to complete, remove from in progress
-            r.rpush(queues["write"], json_item)
-            r.lrem(queues["work"], json_item)
-            r.set(status, "%s: Waiting for work"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
-            #print("Done")
-            # all done, go to the top and start again!
-            continue
-        except Exception as e:
-            # something went wrong with image processing
-            error = {"error": str(e),
-                     "timestamp": datetime.now().strftime("%d/%m/%y %H:%M:%S"),
-                     "data": item}
-            r.lpush(queues["error"], json.dumps(error))
-            r.lrem(queues["work"], json_item)
-            r.set(status, "%s: Waiting for work"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
+        if batch_size > 1:
+            r.set(status, "%s: Processing %s items"%(datetime.now().strftime("%d/%m/%y %H:%M:%S"), len(json_items)))
+        # Each item goes to complete or errors on its own merits, but they're all written (and removed from in
+        # progress) in one go at the end
+        pipe = r.pipeline()
+        for json_item, error in work_on(json_items):
+            finish(pipe, queues, json_item, error)
+            # the page's density has done its job, unless the item errored and might be requeued
+            if error is None and density_key is not None:
+                forget_density(pipe, density_key, json.loads(json_item)["infile"])
+        pipe.set(status, "%s: Waiting for work"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
+        pipe.execute()
+        #print("Done")
+        # all done, go to the top and start again!
+        continue
     else:
         if exit_when_empty:
             r.set(status, "%s: Terminated due to empty queue"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
             sys.exit(1)
+        if blocking_pop:
+            # the pop has already waited for wait_seconds, just show we're still alive
+            r.set(status, "%s: No items in queue, waiting"%datetime.now().strftime("%d/%m/%y %H:%M:%S"))
+            continue
         # no item, wait and try again
         #print("No items in queue, sleeping for %ss"%current_wait)
         r.set(status, "%s: No items in queue, sleeping for %ss"%(datetime.now().strftime("%d/%m/%y %H:%M:%S"),current_wait))
@@ -0,0 +1,86 @@
+'''Parity checks for crop_engine.props_for_contours.
+
+    python -m pytest -q test_crop_engine.py
+
+mode='labels' has to give the same boxes and pixel sums as the original
+mode='draw' on whatever contours the component search throws at it, so
+these build random pages of nested, touching and overlapping shapes over a
+speckled edge map and compare the two.
+'''
+
+import cv2
+import numpy as np
+import pytest
+
+from crop_engine import find_contours, find_optimal_components_subset, props_for_contours
+
+
+def random_page(seed, height=300, width=400):
+    """(shapes, edges): a 0/1 image of random filled and hollow rectangles
+    and ellipses, rings inside rings and overlapping blobs, and a 0/255
+    speckled edge map to sum over."""
+    rng = np.random.RandomState(seed)
+    shapes = np.zeros((height, width), dtype=np.uint8)
+    for _ in range(rng.randint(5, 25)):
+        x, y = rng.randint(0, width - 20), rng.randint(0, height - 20)
+        w, h = rng.randint(3, width - x), rng.randint(3, height - y)
+        thickness = -1 if rng.rand() < 0.4 else rng.randint(1, 4)
+        if rng.rand() < 0.5:
+            cv2.rectangle(shapes, (x, y), (x + w, y + h), 1, thickness)
+        else:
+            cv2.ellipse(shapes, (x + w // 2, y + h // 2), (w // 2, h // 2), rng.randint(0, 180), 0, 360, 1,
+                        thickness)
+        if rng.rand() < 0.3:
+            # a ring nested inside, maybe with a blob inside that
+            cx, cy = x + w // 2, y + h // 2
+            cv2.circle(shapes, (cx, cy), max(1, min(w, h) // 4), 1, 1)
+            if rng.rand() < 0.5:
+                cv2.circle(shapes, (cx, cy), max(1, min(w, h) // 10), 1, -1)
+    edges = (rng.rand(height, width) < 0.2).astype(np.uint8) * 255
+    edges |= shapes * 255
+    return shapes, edges
+
+
+def assert_same_props(contours, edges):
+    labels = props_for_contours(contours, edges, mode='labels')
+    drawn = props_for_contours(contours, edges, mode='draw')
+    assert len(labels) == len(drawn) == len(contours)
+    for i, (got, want) in enumerate(zip(labels, drawn)):
+        assert (got['x1'], got['y1'], got['x2'], got['y2']) == (want['x1'], want['y1'], want['x2'], want['y2']), i
+        assert got['sum'] == pytest.approx(want['sum']), i
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_labels_match_draw_tree(seed):
+    shapes, edges = random_page(seed)
+    contours, _ = find_contours(shapes)
+    assert_same_props(contours, edges)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_labels_match_draw_list(seed):
+    shapes, edges = random_page(1000 + seed)
+    contours, _ = find_contours(shapes, mode=cv2.RETR_LIST)
+    assert_same_props(contours, edges)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_labels_match_draw_dilated(seed):
+    # what find_components hands over: the contours of a dilated edge map
+    shapes, edges = random_page(2000 + seed)
+    dilated = cv2.dilate(shapes, np.ones((3, 3), dtype=np.uint8), iterations=2)
+    contours, _ = find_contours(dilated)
+    assert_same_props(contours, edges)
+
+
+def test_no_contours():
+    assert props_for_contours([], np.zeros((10, 10), dtype=np.uint8)) == []
+
+
+def test_zero_area_crop_takes_nothing():
+    # the biggest component is a zero-width box, so the crop so far has no area to grow from
+    edges = np.zeros((200, 200), dtype=np.uint8)
+    edges[:2, :150] = 255
+    c_info = [{'x1': 10, 'y1': 10, 'x2': 10, 'y2': 50, 'sum': 200},
+              {'x1': 10, 'y1': 50, 'x2': 12, 'y2': 60, 'sum': 90}]
+    assert find_optimal_components_subset(None, edges, c_info) == (10, 10, 10, 50)
@@ -0,0 +1,146 @@
+'''Checks for ocr_engine.PyocrEngine against stand-ins for pyocr's tools.
+
+    python -m pytest -q test_ocr_engine.py
+
+read() has to give the same text as text(), paragraph breaks and all, so
+these run both through stub tools that hand pyocr's real builders what
+Tesseract gave for a two paragraph page. unrotate_lines() has to put the
+boxes from a straightened page back where they were on the page.
+'''
+
+import io
+
+import cv2
+import pytest
+from PIL import Image
+
+pyocr = pytest.importorskip("pyocr")
+import pyocr.builders
+import pyocr.tesseract
+
+from ocr_engine import PyocrEngine, line_record, unrotate_lines
+
+# Tesseract 5.5's text and hOCR output for a page of two paragraphs of two lines
+TXT = u"The quick brown fox\njumps over the dog.\n\nA new paragraph & more\ntext <here>.\n"
+
+HOCR = u'''  <div class='ocr_page' id='page_1' title='image "unknown"; bbox 0 0 700 260; ppageno 0; scan_res 96 96'>
+   <div class='ocr_carea' id='block_1_1' title="bbox 30 28 306 96">
+    <p class='ocr_par' id='par_1_1' lang='eng' title="bbox 30 28 306 96">
+     <span class='ocr_line' id='line_1_1' title="bbox 31 28 306 56; baseline 0 -6; x_size 28; x_descenders 6; x_ascenders 6">
+      <span class='ocrx_word' id='word_1_1' title='bbox 31 28 82 50; x_wconf 91'>The</span>
+      <span class='ocrx_word' id='word_1_2' title='bbox 90 29 163 56; x_wconf 91'>quick</span>
+      <span class='ocrx_word' id='word_1_3' title='bbox 172 29 256 50; x_wconf 92'>brown</span>
+      <span class='ocrx_word' id='word_1_4' title='bbox 265 28 306 50; x_wconf 92'>fox</span>
+     </span>
+     <span class='ocr_line' id='line_1_2' title="bbox 30 68 294 96; baseline 0 -6; x_size 28; x_descenders 6; x_ascenders 6">
+      <span class='ocrx_word' id='word_1_5' title='bbox 30 70 111 96; x_wconf 88'>jumps</span>
+      <span class='ocrx_word' id='word_1_6' title='bbox 119 74 178 90; x_wconf 92'>over</span>
+      <span class='ocrx_word' id='word_1_7' title='bbox 185 68 228 90; x_wconf 92'>the</span>
+      <span class='ocrx_word' id='word_1_8' title='bbox 236 69 294 96; x_wconf 90'>dog.</span>
+     </span>
+    </p>
+   </div>
+   <div class='ocr_carea' id='block_1_2' title="bbox 31 158 360 220">
+    <p class='ocr_par' id='par_1_2' lang='eng' title="bbox 31 158 360 220">
+     <span class='ocr_line' id='line_1_3' title="bbox 31 158 360 186; baseline 0 -6; x_size 28.5; x_descenders 5.5; x_ascenders 6.5">
+      <span class='ocrx_word' id='word_1_9' title='bbox 31 160 49 180; x_wconf 77'>A</span>
+      <span class='ocrx_word' id='word_1_10' title='bbox 57 164 113 180; x_wconf 77'>new</span>
+      <span class='ocrx_word' id='word_1_11' title='bbox 122 158 258 186; x_wconf 90'>paragraph</span>
+      <span class='ocrx_word' id='word_1_12' title='bbox 268 160 285 180; x_wconf 93'>&amp;</span>
+      <span class='ocrx_word' id='word_1_13' title='bbox 293 164 360 180; x_wconf 92'>more</span>
+     </span>
+     <span class='ocr_line' id='line_1_4' title="bbox 31 198 188 220; baseline 0 0; x_size 27.333334; x_descenders 5.3333335; x_ascenders 6">
+      <span class='ocrx_word' id='word_1_14' title='bbox 31 200 80 220; x_wconf 91'>text</span>
+      <span class='ocrx_word' id='word_1_15' title='bbox 90 198 188 220; x_wconf 56'>&lt;here&gt;.</span>
+     </span>
+    </p>
+   </div>
+  </div>
+'''
+
+
+class CommandLineTool(object):
+    """Like pyocr.tesseract: runs tesseract with the builder's flags and
+    configs, then has the builder read the first output file it asks for."""
+
+    def __init__(self):
+        self.flags = []
+
+    def get_name(self):
+        return "Tesseract (sh)"
+
+    def get_version(self):
+        return (5, 5, 1)
+
+    def image_to_string(self, image, lang=None, builder=None):
+        self.flags.append(builder.tesseract_flags)
+        outputs = {"txt": TXT, "hocr": HOCR}
+        ext = [e for e in builder.file_extensions if e in outputs][0]
+        return builder.read_file(io.StringIO(outputs[ext]))
+
+
+class LibraryTool(CommandLineTool):
+    """Like pyocr.libtesseract: walks the result line by line and word by
+    word through the builder's start_line/add_word/end_line."""
+
+    def get_name(self):
+        return "Tesseract (C-API)"
+
+    def image_to_string(self, image, lang=None, builder=None):
+        self.flags.append(builder.tesseract_layout)
+        lines = [(((31, 28), (306, 56)), [("The", ((31, 28), (82, 50)), 91), ("fox", ((265, 28), (306, 50)), 92)]),
+                 (((30, 68), (294, 96)), [("dog.", ((236, 69), (294, 96)), 90)])]
+        for box, words in lines:
+            builder.start_line(box)
+            for word, word_box, conf in words:
+                builder.add_word(word, word_box, conf)
+            builder.end_line()
+        return builder.get_output()
+
+
+@pytest.fixture
+def engine_for(monkeypatch):
+    # so the builders don't go looking for a tesseract binary for its version
+    monkeypatch.setattr(pyocr.tesseract, "g_version", (5, 5, 1))
+
+    def engine_for(tool):
+        monkeypatch.setattr(pyocr, "get_available_tools", lambda: [tool])
+        return PyocrEngine()
+    return engine_for
+
+
+def test_read_text_matches_text(engine_for):
+    tool = CommandLineTool()
+    engine = engine_for(tool)
+    image = Image.new("L", (700, 260), 255)
+    text, lines = engine.read(image, "eng")
+    assert text == engine.text(image, "eng") == TXT.strip()
+    # both at the same page segmentation
+    assert tool.flags[0] == tool.flags[1] == ["--psm", "3"]
+    assert [line["text"] for line in lines] == TXT.replace("\n\n", "\n").strip().split("\n")
+    assert lines[0]["box"] == [31, 28, 306, 56]
+    assert lines[0]["words"][0] == ["The", 31, 28, 82, 50, 91.0]
+    assert lines[3]["conf"] == 73.5
+
+
+def test_read_text_matches_text_libtesseract(engine_for):
+    tool = LibraryTool()
+    engine = engine_for(tool)
+    image = Image.new("L", (700, 260), 255)
+    text, lines = engine.read(image, "eng")
+    assert text == engine.text(image, "eng") == u"The fox\ndog."
+    assert tool.flags == [3, 3]
+    assert lines[1]["words"] == [["dog.", 236, 69, 294, 96, 90.0]]
+
+
+def test_unrotate_lines():
+    # a word near the corner of a page preprocess() turned by 3 degrees goes back where it was on the page
+    size, angle = (1700, 2400), 3.0
+    m = cv2.getRotationMatrix2D((size[0] / 2.0, size[1] / 2.0), angle, 1)
+    x, y = m.dot([120, 110, 1])
+    box = [int(round(x)) - 20, int(round(y)) - 10, int(round(x)) + 20, int(round(y)) + 10]
+    lines = unrotate_lines([line_record(list(box), [["word"] + box + [90.0]])], angle, size)
+    x1, y1, x2, y2 = lines[0]["words"][0][1:5]
+    assert lines[0]["box"] == [x1, y1, x2, y2]
+    assert abs((x1 + x2) / 2.0 - 120) <= 1 and abs((y1 + y2) / 2.0 - 110) <= 1
+    assert 40 <= x2 - x1 <= 44 and 20 <= y2 - y1 <= 24
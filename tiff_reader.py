@@ -0,0 +1,94 @@
+'''Low memory access to big uncompressed TIFF masters.
+
+The masters (e.g. images/tiff/134663395.tiff) are plain uncompressed strips,
+so rather than decoding the whole page into memory (and then making several
+full size copies of it), map the pixel data straight from the file and only
+read the rows that are actually needed.
+'''
+
+import cv2
+import numpy as np
+from PIL import Image
+
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIG = 284
+TILE_WIDTH = 322
+
+
+def tiff_memmap(path):
+    """Memory map the pixels of an uncompressed 8-bit TIFF.
+
+    Returns a read-only (height, width) or (height, width, 3) uint8 array
+    backed by the file, or None if the file isn't a TIFF laid out that way
+    (compressed, tiled, planar, 16-bit, or with strips out of order) or its
+    samples don't mean what PIL's would (e.g. WhiteIsZero grayscale, which
+    PIL inverts as it decodes).
+    """
+    im = Image.open(path)
+    try:
+        if im.format != 'TIFF' or im.mode not in ('L', 'RGB'):
+            return None
+        if im.info.get('compression') != 'raw' or getattr(im, 'n_frames', 1) != 1:
+            return None
+        tags = im.tag_v2
+        if TILE_WIDTH in tags or tags.get(PLANAR_CONFIG, 1) != 1:
+            return None
+        # BlackIsZero for L, RGB for RGB
+        if tags.get(PHOTOMETRIC) != {'L': 1, 'RGB': 2}[im.mode]:
+            return None
+        offsets = tags.get(STRIP_OFFSETS)
+        counts = tags.get(STRIP_BYTE_COUNTS)
+        if not offsets or not counts:
+            return None
+        offsets, counts = list(offsets), list(counts)
+        # Strips have to follow on from one another to map them as one block
+        for i in range(1, len(offsets)):
+            if offsets[i] != offsets[i - 1] + counts[i - 1]:
+                return None
+        w, h = im.size
+        channels = len(im.mode)
+        if sum(counts) < w * h * channels:
+            return None
+    finally:
+        im.close()
+
+    shape = (h, w) if channels == 1 else (h, w, channels)
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=offsets[0], shape=shape)
+
+
+def gray_proxy(pixels, max_dim, band_rows=512):
+    """Build a grayscale copy of pixels shrunk to max_dim on the long side.
+
+    The image is read band_rows rows at a time, so only one band of full
+    resolution pixels is ever in memory.
+
+    Returns scale, proxy (a 2D uint8 array).
+    """
+    h, w = pixels.shape[:2]
+    scale = min(1.0, 1.0 * max_dim / max(w, h))
+    out_w, out_h = max(1, int(w * scale)), max(1, int(h * scale))
+    proxy = np.empty((out_h, out_w), dtype=np.uint8)
+
+    # Whole numbers of output rows per band, so bands resize independently
+    out_rows = max(1, int(band_rows * scale))
+    y = 0
+    while y < out_h:
+        y_end = min(out_h, y + out_rows)
+        src_start = int(round(y / scale))
+        src_end = h if y_end == out_h else int(round(y_end / scale))
+        band = np.asarray(pixels[src_start:src_end])
+        if band.ndim == 3:
+            band = cv2.cvtColor(band, cv2.COLOR_RGB2GRAY)
+        proxy[y:y_end] = cv2.resize(band, (out_w, y_end - y), interpolation=cv2.INTER_AREA)
+        y = y_end
+    return scale, proxy
+
+
+def crop_region(pixels, box):
+    """Read just the rows and columns inside box (x1, y1, x2, y2) as an
+    Image, ready to save."""
+    x1, y1, x2, y2 = box
+    return Image.fromarray(np.ascontiguousarray(pixels[y1:y2, x1:x2]))
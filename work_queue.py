@@ -0,0 +1,174 @@
+'''Redis bookkeeping shared by image_worker.py and ocr_worker.py.
+
+Each worker has a dict of queue names:
+
+    queues = {"read": "images:to_process",   # waiting to be done
+              "write": "images:processed",   # done
+              "work": "images:in_progress",  # being done
+              "error": "images:errors"}      # failed, with the reason
+
+Moving an item out of progress (to processed, or to errors) is queued up
+on a pipeline by finish() and sent as one MULTI/EXEC, so it's a single
+round trip and a crash can't leave an item both processed and in progress.
+The same calls work on a redis.asyncio pipeline, just await the execute().
+
+Each worker keeps its items in progress on a list of its own (see
+worker_queues()), so finishing one only has to search that worker's few
+items, and holds a lease on them: an expiry time in the leases hash, which
+it renews every so often while it's alive. reap() puts the items of any
+worker whose lease has run out (i.e. it has died) back on the queue.
+
+The crop stage leaves each page's text density (see crop_stats.text_density)
+in a hash keyed by the cropped file's path, for the OCR stage to pick up
+with get_density() and skip blank pages.
+'''
+
+import json
+from datetime import datetime
+from time import time
+
+
+def timestamp():
+    return datetime.now().strftime("%d/%m/%y %H:%M:%S")
+
+
+def error_record(message, data):
+    """What goes on the error queue: the reason, when, and the item itself."""
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", "replace")
+    return {"error": message,
+            "timestamp": timestamp(),
+            "data": data}
+
+
+def finish(pipe, queues, json_item, error=None, status=None):
+    """Queue up the commands that take json_item out of progress: onto the
+    processed queue, or the error queue with error (an error_record()) if
+    there is one. If status is given, that worker's status key is set back
+    to waiting for work in the same transaction.
+
+    Returns pipe, ready to execute().
+    """
+    if error is None:
+        pipe.rpush(queues["write"], json_item)
+    else:
+        pipe.lpush(queues["error"], json.dumps(error))
+    pipe.lrem(queues["work"], 0, json_item)
+    if status is not None:
+        pipe.set(status, "%s: Waiting for work" % timestamp())
+    return pipe
+
+
+# Move up to ARGV[1] items from the queue to in progress, same as that many
+# RPOPLPUSHes, and return them
+TAKE_SCRIPT = """
+local items = {}
+for i = 1, tonumber(ARGV[1]) do
+    local item = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+    if not item then
+        break
+    end
+    items[i] = item
+end
+return items
+"""
+
+
+def take(r, queues, count):
+    """Move up to count items from the queue to in progress in one go.
+
+    Returns a list of them (empty if the queue is)."""
+    return r.eval(TAKE_SCRIPT, 2, queues["read"], queues["work"], count)
+
+
+def pop(r, queues, count=1, timeout=None):
+    """Move up to count items from the queue to in progress and return them
+    as a list, which is empty if there aren't any. With a timeout, block
+    for up to that many seconds waiting for the first one."""
+    if count > 1:
+        json_items = take(r, queues, count)
+        if json_items or not timeout:
+            return json_items
+    if timeout:
+        json_item = r.brpoplpush(queues["read"], queues["work"], timeout=timeout)
+    else:
+        json_item = r.rpoplpush(queues["read"], queues["work"])
+    if not json_item:
+        return []
+    if count > 1:
+        return [json_item] + take(r, queues, count - 1)
+    return [json_item]
+
+
+def worker_queues(queues, worker):
+    """queues for one worker: "work" becomes its own in progress list
+    (e.g. images:in_progress:image_worker_2) and "leases" the hash of all
+    the workers' lease expiry times (images:in_progress:leases)."""
+    queues = dict(queues)
+    queues["leases"] = queues["work"] + ":leases"
+    queues["work_prefix"] = queues["work"] + ":"
+    queues["work"] = queues["work_prefix"] + worker
+    return queues
+
+
+def renew_lease(pipe, queues, worker, lease_seconds):
+    """Queue up extending worker's lease on its items for lease_seconds.
+
+    Returns pipe (which can also be a plain client)."""
+    pipe.hset(queues["leases"], worker, time() + lease_seconds)
+    return pipe
+
+
+# Requeue the items of every worker whose lease expired before ARGV[1] (or
+# of ARGV[3], whatever its lease) onto the front of the queue, so they're
+# picked up next, oldest first.
+REAP_SCRIPT = """
+local requeued = 0
+local leases = redis.call('HGETALL', KEYS[1])
+for i = 1, #leases, 2 do
+    if tonumber(leases[i + 1]) < tonumber(ARGV[1]) or leases[i] == ARGV[3] then
+        local work = ARGV[2] .. leases[i]
+        local item = redis.call('LPOP', work)
+        while item do
+            redis.call('RPUSH', KEYS[2], item)
+            requeued = requeued + 1
+            item = redis.call('LPOP', work)
+        end
+        redis.call('HDEL', KEYS[1], leases[i])
+    end
+end
+return requeued
+"""
+
+
+def record_density(pipe, key, path, density):
+    """Queue up storing density for the page at path in the key hash.
+
+    Returns pipe."""
+    pipe.hset(key, path, json.dumps(density))
+    return pipe
+
+
+def get_density(r, key, path):
+    """The density stored for the page at path, or None if there isn't one."""
+    density = r.hget(key, path)
+    return json.loads(density) if density else None
+
+
+def forget_density(pipe, key, path):
+    """Queue up removing the density stored for the page at path, once
+    whatever needed it is done with it.
+
+    Returns pipe."""
+    pipe.hdel(key, path)
+    return pipe
+
+
+def reap(r, queues, worker=""):
+    """Put the items of workers whose leases have expired back on the queue.
+
+    Also does so for worker whatever its lease says, which a worker should
+    do for its own name when it starts, in case an earlier run of it died
+    mid-item. Returns how many items were requeued.
+    """
+    return r.eval(REAP_SCRIPT, 2, queues["leases"], queues["read"], time(), queues["work_prefix"], worker)
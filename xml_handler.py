@@ -1,6 +1,8 @@
 import xml.etree.ElementTree as ET
+import fcntl
 import os
 import re
+from contextlib import contextmanager
 from time import sleep
 from datetime import datetime
 root_path = "./output/"
@@ -22,42 +24,65 @@ def getfh(dir, filename, retry = False):
     path = root_path + dir + "/" + filename + ".xml"
     if os.path.exists(root_path + dir):
         try:
-            fh = open(path, "r+")
+            fh = open(path, "rb+")
             return fh
         except IOError:
-            fh = open(path, "w+")
+            fh = open(path, "wb+")
             return fh
         except OSError:
             if not retry:
                 sleep(5)
-                getfh(dir, filename, retry = True)
+                return getfh(dir, filename, retry = True)
             else:
                 return None
 
     else:
         os.makedirs(root_path + dir)
-        getfh(dir, filename)
+        return getfh(dir, filename)
+
+@contextmanager
+def locked(shelfmark, index):
+    """
+    Hold an exclusive lock on a record (by a .lock file beside it) for a
+    gettree(), changes and writetree(), so that workers updating the same
+    record don't lose each other's changes. Only stops others using locked().
+    """
+    dir = root_path + get_valid_filename(shelfmark)
+    if not os.path.exists(dir):
+        os.makedirs(dir, exist_ok=True)
+    with open(dir + "/" + index + ".xml.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
 def writetree(shelfmark, index, tree):
     try:
         fh = getfh(shelfmark, index)
-        ET.ElementTree(tree).write(fh, encoding="UTF-8", xml_declaration=True)
+        try:
+            ET.ElementTree(tree).write(fh, encoding="UTF-8", xml_declaration=True)
+            fh.truncate()
+        finally:
+            fh.close()
         return True
     except Exception as e:
-        print e
+        print(e)
 
 def gettree(shelfmark, index):
-    try:
-        fh = getfh(shelfmark, index)
-    except Exception as e:
-        print e
+    # if the record can't be opened, don't go on to write a new one over it
+    fh = getfh(shelfmark, index)
+    if fh is None:
+        raise IOError("Could not open the record for %s %s" % (shelfmark, index))
 
     try:
         tree = ET.parse(fh)
         tree = tree.getroot()
     except ET.ParseError:
-        print "parsing error = generating new file"
+        print("parsing error = generating new file")
         tree = createtree(shelfmark, index)
+    finally:
+        fh.close()
 
     return tree
 